@@ -1,30 +1,607 @@
+from __future__ import with_statement
 import os
+import imp
+import time
+import types
+import marshal
+import fnmatch
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
+
+#marshal's format changes between Python versions
+magic = imp.get_magic()
+
+#the fields of the entries in a Cache's linked list
+PREV, NEXT, KEY, MTIME, CHECKED, VAL, SIZE = range(7)
 
 class Cache(object):
+    """
+Compiled templates keyed by (path, fingerprint), so that the code a file
+compiles to with different options can be cached side by side.  An entry is
+dropped when the file at path is found to be modified.
+
+How often the file is checked is given to get as interval: 0 checks on every
+lookup, a number of seconds checks at most that often and None never checks.
+invalidate drops entries explicitly.  Every check is a single stat call.
+
+The cache holds at most maxsize entries and maxbytes bytes (as estimated by
+whoever sets the entries), evicting the least recently used entries to stay
+within them.  None means no limit.  on_evict is called with the key of every
+entry that is dropped, for whatever else is kept per entry.  hits, misses and
+evictions count the lookups and evictions so far.
+    """
     
-    def __init__(self):
+    def __init__(self, maxsize=None, maxbytes=None, on_evict=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.on_evict = on_evict
         self.cache = {}
+        #circular doubly linked list of the entries, most recently used first
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, None, None, 0]
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
     
-    def __contains__(self, key):
-        if not os.path.isfile(key) or not key in self.cache:
-            return False
+    def lookup(self, key, interval):
+        """
+Returns the entry for key if it is there and the file has not been modified.
+        """
+        link = self.cache.get(key)
+        if link is None or interval is None:
+            return link
         
-        (k,_) = self.cache[key]
-        if k < os.path.getmtime(key):
-            del self.cache[key]
-            return False
+        now = time.time()
+        if interval and now - link[CHECKED] < interval:
+            return link
         
-        return True
+        try:
+            modified = os.stat(key[0]).st_mtime > link[MTIME]
+        except OSError:
+            modified = True
+        if modified:
+            self.drop(link)
+            return None
+        
+        link[CHECKED] = now
+        return link
+    
+    def get(self, key, interval=0):
+        """
+Returns the value cached for key, or None if there is none or the file has been
+modified.
+        """
+        link = self.lookup(key, interval)
+        if link is None:
+            self.misses += 1
+            return None
+        
+        self.hits += 1
+        if link is not self.root[NEXT]:
+            #move to the front
+            link[PREV][NEXT] = link[NEXT]
+            link[NEXT][PREV] = link[PREV]
+            self.insert(link)
+        return link[VAL]
+    
+    def peek(self, key, interval=0):
+        """
+Like get, but without counting the lookup or making the entry recently used.
+        """
+        link = self.lookup(key, interval)
+        return link and link[VAL]
+    
+    def set(self, key, val, mtime=None, size=0):
+        """
+Caches val for key.  mtime is the modification time of the file the value was
+made from, taken before reading it.  size is the estimated size of the entry in
+bytes.
+        """
+        if mtime is None:
+            try:
+                mtime = os.stat(key[0]).st_mtime
+            except OSError:
+                raise IOError('invalid file path: ' + key[0])
+        
+        if key in self.cache:
+            self.unlink(self.cache[key])
+        link = [None, None, key, mtime, time.time(), val, size]
+        self.insert(link)
+        self.cache[key] = link
+        self.bytes += size
+        self.shrink()
+    
+    def insert(self, link):
+        root = self.root
+        link[PREV] = root
+        link[NEXT] = root[NEXT]
+        root[NEXT][PREV] = link
+        root[NEXT] = link
+    
+    def unlink(self, link):
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+        del self.cache[link[KEY]]
+        self.bytes -= link[SIZE]
+    
+    def drop(self, link):
+        self.unlink(link)
+        if self.on_evict:
+            self.on_evict(link[KEY])
+    
+    def shrink(self):
+        """
+Evicts the least recently used entries until the cache is within its limits,
+always keeping the most recent one.
+        """
+        while len(self.cache) > 1 and (
+                self.maxsize is not None and len(self.cache) > self.maxsize or
+                self.maxbytes is not None and self.bytes > self.maxbytes):
+            self.drop(self.root[PREV])
+            self.evictions += 1
+    
+    def invalidate(self, path=None):
+        """
+Drops the entries for the file at path, or every entry if path is None.
+        """
+        for key in list(self.cache):
+            if path is None or key[0] == path:
+                self.drop(self.cache[key])
+    
+    def stats(self):
+        """
+Returns a dictionary of the counters, the number of entries and their size.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.cache),
+            'bytes': self.bytes,
+        }
+    
+    def __len__(self):
+        return len(self.cache)
+    
+    def __contains__(self, key):
+        return self.peek(key) is not None
     
     def __getitem__(self, key):
-        if not key in self:
+        val = self.get(key)
+        if val is None:
             raise KeyError(key)
         
-        (k,v) = self.cache[key]
-        return v
+        return val
     
     def __setitem__(self, key, val):
-        if not os.path.isfile(key):
-            raise IOError('invalid file path: ' + key)
+        self.set(key, val)
+
+class FragmentCache(object):
+    """
+The fragments of HTML cached by _haml.cached blocks, kept in memory.  Entries
+set with a ttl expire that many seconds later, and the cache holds at most
+maxsize entries.  Any object with the same get and set methods can be used as
+Engine.fragments instead, to share fragments between processes for instance.
+    """
+    
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.cache = {}
+    
+    def get(self, key):
+        """
+Returns the fragment for key, or None if there is none or it has expired.
+        """
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        
+        (expires, val) = entry
+        if expires is not None and expires <= time.time():
+            del self.cache[key]
+            return None
         
-        self.cache[key] = (os.path.getmtime(key), val)
+        return val
+    
+    def set(self, key, val, ttl=None):
+        if key not in self.cache and len(self.cache) >= self.maxsize:
+            self.purge()
+        expires = None
+        if ttl is not None:
+            expires = time.time() + ttl
+        self.cache[key] = (expires, val)
+    
+    def purge(self):
+        """
+Drops the expired entries, then arbitrary ones until there is room for another.
+        """
+        now = time.time()
+        for (key, (expires, val)) in self.cache.items():
+            if expires is not None and expires <= now:
+                del self.cache[key]
+        while self.cache and len(self.cache) >= self.maxsize:
+            self.cache.popitem()
+    
+    def invalidate(self, name=None):
+        """
+Drops the fragments cached under name, or every fragment if name is None.
+        """
+        for key in list(self.cache):
+            if name is None or key[0] == name:
+                del self.cache[key]
+    
+    def __len__(self):
+        return len(self.cache)
+
+class Index(object):
+    """
+The templates under a list of root directories, so that finding one is a
+dictionary lookup.  names maps the path of a template relative to its root,
+with / separators, to its full path, the first root having it winning.  paths
+holds the full paths and dirs the directories walked.  packages maps the
+relative paths of the directories under the roots to their full paths, in the
+same way.
+
+Adding, removing or renaming a template changes the modification time of its
+directory, and the index is rebuilt when refresh finds one changed.  refresh
+checks at most every interval seconds, always if it is 0 and never if it is
+None, with a stat call per directory.
+    """
+    
+    def __init__(self, roots, pattern='*.haml'):
+        self.roots = roots
+        self.pattern = pattern
+        self.build()
+    
+    def build(self):
+        (names, paths, dirs, packages) = ({}, set(), {}, {})
+        for root in self.roots:
+            root = os.path.normpath(root)
+            for (dir, subdirs, files) in os.walk(root):
+                subdirs.sort()
+                try:
+                    dirs[dir] = os.stat(dir).st_mtime
+                except OSError:
+                    continue
+                prefix = dir[len(root):].strip(os.sep).replace(os.sep, '/')
+                if prefix:
+                    packages.setdefault(prefix, dir)
+                for name in sorted(fnmatch.filter(files, self.pattern)):
+                    path = os.path.join(dir, name)
+                    names.setdefault(prefix and prefix + '/' + name or name,
+                        path)
+                    paths.add(path)
+        (self.names, self.paths, self.dirs) = (names, paths, dirs)
+        self.packages = packages
+        self.checked = time.time()
+    
+    def refresh(self, interval=0):
+        """
+Rebuilds the index if a directory in it changed, checking only if interval
+seconds have passed since the last check.  Returns whether it was rebuilt.
+        """
+        if interval is None or time.time() - self.checked < interval:
+            return False
+        self.checked = time.time()
+        for (dir, mtime) in self.dirs.iteritems():
+            try:
+                changed = os.stat(dir).st_mtime != mtime
+            except OSError:
+                changed = True
+            if changed:
+                self.build()
+                return True
+        return False
+    
+    def find(self, name):
+        """
+Returns the full path of the template named name relative to a root, or None.
+        """
+        return self.names.get(name)
+    
+    def __contains__(self, path):
+        return path in self.paths
+    
+    def __len__(self):
+        return len(self.paths)
+
+def estimate(code, haml_lines):
+    """
+Returns the estimated size in bytes of a compiled template and its line map.
+The marshalled size of the code stands in for the size of the code object.
+    """
+    size = len(marshal.dumps(code))
+    for (_, line) in haml_lines:
+        #the tuple, the int and the string headers take about 100 bytes
+        size += len(line) + 100
+    return size
+
+class DiskCache(object):
+    """
+A directory of compiled templates shared between processes, like __pycache__.
+Each entry holds the marshalled code object of a template and its Haml line
+map.  Entries are named after the template path and the fingerprint of the
+options it was compiled with, and are only used while the Python version, the
+fingerprint and the modification time and size of the template all match.
+Entries are written to a temporary file and renamed into place, so readers
+never see a partly written entry.  Entries are not removed when they go stale,
+call prune to clear them out.
+    """
+    
+    def __init__(self, dir):
+        self.dir = dir
+    
+    def header(self, key, fingerprint, stat):
+        return (os.path.abspath(key), fingerprint, stat.st_mtime, stat.st_size)
+    
+    def path(self, key, fingerprint):
+        digest = sha1(('%s\0%s' % (os.path.abspath(key), fingerprint)).encode('utf-8'))
+        name = os.path.basename(key)
+        return os.path.join(self.dir, '%s.%s.hamlc' % (name, digest.hexdigest()[:16]))
+    
+    def load(self, key, fingerprint, stat=None):
+        """
+Returns (code, haml_lines) for the template at path key, or None if there is no
+valid entry for it.
+        """
+        try:
+            stat = stat or os.stat(key)
+            with open(self.path(key, fingerprint), 'rb') as f:
+                if f.read(len(magic)) != magic:
+                    return None
+                header = marshal.load(f)
+                if header != self.header(key, fingerprint, stat):
+                    return None
+                return marshal.load(f)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+    
+    def store(self, key, fingerprint, code, haml_lines, stat=None):
+        """
+Writes the entry for the template at path key.  Failures are ignored, the
+cache is only an optimisation.
+        """
+        try:
+            stat = stat or os.stat(key)
+            if not os.path.isdir(self.dir):
+                os.makedirs(self.dir)
+            import tempfile
+            (fd, tmp) = tempfile.mkstemp(dir=self.dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(magic)
+                    marshal.dump(self.header(key, fingerprint, stat), f)
+                    marshal.dump((code, haml_lines), f)
+                rename(tmp, self.path(key, fingerprint))
+            except:
+                os.remove(tmp)
+                raise
+        except (IOError, OSError, ValueError):
+            pass
+    
+    def prune(self, fingerprints=None):
+        """
+Removes the entries whose template has been deleted or changed since it was
+compiled, and those that cannot be read.  If fingerprints is given, entries
+compiled with any other fingerprint are removed as well, pass the fingerprint
+and import_fingerprint of the engines still using the cache.  Returns the
+number of entries removed.
+        """
+        try:
+            names = os.listdir(self.dir)
+        except OSError:
+            return 0
+        removed = 0
+        for name in fnmatch.filter(names, '*.hamlc'):
+            path = os.path.join(self.dir, name)
+            try:
+                with open(path, 'rb') as f:
+                    header = None
+                    if f.read(len(magic)) == magic:
+                        header = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                header = None
+            except (IOError, OSError):
+                continue
+            try:
+                (key, fingerprint) = header[:2]
+                stale = header != self.header(key, fingerprint, os.stat(key))
+            except (TypeError, ValueError, OSError):
+                stale = True
+            if not stale and fingerprints is not None:
+                stale = fingerprint not in fingerprints
+            if stale:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
+
+class MapFile(object):
+    """
+A read-only file over an mmap, for zipfile, which reads to the end of a file
+with read() while Python 2's mmap.read needs a size.
+    """
+    
+    def __init__(self, map):
+        self.map = map
+        self.seek = map.seek
+        self.tell = map.tell
+    
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.map) - self.map.tell()
+        return self.map.read(size)
+
+class Archive(object):
+    """
+A zip archive of templates, opened once and read through mmap.  Templates are
+named by their path in the archive with / separators, and are rendered as
+files under path, the absolute path of the archive, as if it were a directory.
+prefix is path followed by a separator.
+
+An archive written by pack_archive can also hold the code of its templates
+compiled with one set of options.  Such an entry is only used with the same
+Python version and fingerprint.  It is keyed by the name of the template, and
+the path it is loaded from is set in its code when it is read, so the archive
+works wherever it is moved to.
+
+Deploying a new archive by renaming it over the old one is atomic.  refresh
+notices the new file and reopens it, checking at most every interval seconds
+as Index.refresh does.
+    """
+    
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.prefix = os.path.join(self.path, '')
+        self.open()
+    
+    def open(self):
+        #imported here so that importing pyhaml without an archive stays cheap
+        import mmap
+        import zipfile
+        with open(self.path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            #the map keeps a file descriptor of its own
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.zip = zipfile.ZipFile(MapFile(self.map))
+        self.names = set(self.zip.namelist())
+        #the directories in the archive, which templates import as packages
+        self.dirs = set()
+        for name in self.names:
+            parts = name.split('/')[:-1]
+            for i in range(1, len(parts) + 1):
+                self.dirs.add('/'.join(parts[:i]))
+        self.stat = (stat.st_ino, stat.st_mtime, stat.st_size)
+        self.checked = time.time()
+    
+    def refresh(self, interval=0):
+        """
+Reopens the archive if the file at path was replaced or modified, checking
+only if interval seconds have passed since the last check.  Returns whether it
+was reopened.
+        """
+        if interval is None or time.time() - self.checked < interval:
+            return False
+        self.checked = time.time()
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            #keep serving the old archive until a new one is in place
+            return False
+        if (stat.st_ino, stat.st_mtime, stat.st_size) == self.stat:
+            return False
+        self.zip.close()
+        self.map.close()
+        self.open()
+        return True
+    
+    def name(self, path):
+        """
+Returns the name in the archive of the template at path, which may or may not
+be there, or None if path is not under the archive.
+        """
+        if path.startswith(self.prefix):
+            return path[len(self.prefix):].replace(os.sep, '/')
+        return None
+    
+    def read(self, name):
+        return self.zip.read(name)
+    
+    def load(self, name, fingerprint, filename):
+        """
+Returns (code, haml_lines) for the template called name compiled with the
+options of fingerprint, or None if the archive has no valid entry for it.  The
+code names filename as its file in errors.
+        """
+        entry = code_entry(name, fingerprint)
+        if entry not in self.names:
+            return None
+        data = self.zip.read(entry)
+        if data[:len(magic)] != magic:
+            return None
+        try:
+            (header, code, haml_lines) = marshal.loads(data[len(magic):])
+        except (EOFError, ValueError, TypeError):
+            return None
+        if header != (fingerprint, name):
+            return None
+        return (relocate(code, placeholder(name), filename), haml_lines)
+    
+    def __contains__(self, name):
+        return name in self.names
+
+def code_entry(name, fingerprint):
+    """
+Returns the name of the archive entry holding the code of the template called
+name compiled with the options of fingerprint.
+    """
+    return '%s.%s.hamlc' % (name, sha1(fingerprint).hexdigest()[:16])
+
+def placeholder(name):
+    """
+Returns the filename the template called name is compiled under for
+pack_archive, which Archive.load replaces with the path it is loaded from.
+    """
+    return '<archive %s>' % name
+
+def relocate(code, old, new):
+    """
+Returns the module code object code with the string constant old, the filename
+it was compiled under, replaced by new.
+    """
+    consts = list(code.co_consts)
+    for (i, const) in enumerate(consts):
+        if type(const) is str and const == old:
+            consts[i] = new
+    return types.CodeType(code.co_argcount, code.co_nlocals,
+        code.co_stacksize, code.co_flags, code.co_code, tuple(consts),
+        code.co_names, code.co_varnames, code.co_filename, code.co_name,
+        code.co_firstlineno, code.co_lnotab, code.co_freevars,
+        code.co_cellvars)
+
+def pack_archive(dest, templates):
+    """
+Writes the archive at dest, replacing it atomically.  templates is a list of
+(name, source, compiled) tuples, where compiled is a list of (fingerprint,
+code, haml_lines) tuples, empty for templates that are only stored as source.
+The code must have been compiled under the filename placeholder(name).
+Entries are stored uncompressed, so that reading one is a plain copy out of the
+map.
+    """
+    import tempfile
+    import zipfile
+    dest = os.path.abspath(dest)
+    (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(dest), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            archive = zipfile.ZipFile(f, 'w', zipfile.ZIP_STORED)
+            for (name, src, compiled) in templates:
+                archive.writestr(name, src)
+                for (fingerprint, code, haml_lines) in compiled:
+                    header = (fingerprint, name)
+                    archive.writestr(code_entry(name, fingerprint),
+                        magic + marshal.dumps((header, code, haml_lines)))
+            archive.close()
+        rename(tmp, dest)
+    except:
+        os.remove(tmp)
+        raise
+
+def rename(src, dst):
+    """
+Renames src to dst, replacing dst.  This is atomic on POSIX systems, elsewhere
+dst is removed first if the rename fails.
+    """
+    try:
+        os.rename(src, dst)
+    except OSError:
+        if not os.path.exists(dst):
+            raise
+        os.remove(dst)
+        os.rename(src, dst)
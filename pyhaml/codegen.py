@@ -0,0 +1,314 @@
+import re
+import ast
+
+from parser import Static
+
+class CodeGenerator(object):
+    """
+Builds the AST of a Python module from the HamlCalls produced by the parser, so
+that the generated code never goes through Python source text.  Only the
+Python written in the template (scripts, attribute dictionaries, inline
+Python) is parsed, one fragment at a time.
+
+Every HamlCall is given a line number of its own, so haml_lines[n] is the Haml
+(line number, code) pair for the Python code at line n.
+
+The module sets HAML_reusable to whether the template only defines functions
+and classes and imports modules at its top level, without reading any name
+from the render while doing so.  A render function template is never reusable,
+since its functions close over the arguments of the first call.
+
+If context is not None the template is compiled into a render function called
+HAML_render, which the module calls right away.  _haml, its bound write and
+indent methods and the names in context are arguments, so the template reads
+them as fast locals rather than global dictionary lookups.  A context name
+that the render does not set is None.  The function returns locals() for the module to update its globals with, so the defs in a
+template can still be imported.
+    """
+
+    def __init__(self, filename, context=None):
+        self.filename = filename
+        self.context = context
+        #calls made through a bound method held by the render function
+        self.bound = ()
+        if context is not None:
+            self.bound = ('write', 'indent')
+        self.haml_lines = [(0, "<no line 0>"), (0, "<HAML setup>")]
+        #maps the id of a statement list to the statement at its end that an
+        #else, elif, except or finally line continues
+        self.compound = {}
+        #try statements, which need an except or finally clause
+        self.tries = []
+        #decorators waiting for the def or class they decorate
+        self.decorators = []
+
+    def generate(self, calls):
+        """
+Returns an ast.Module for a list of HamlCalls.  Raises SyntaxError with the
+line number of the offending call if the Python in the template is invalid.
+        """
+        #important for file to be "<haml>" so execute() can detect Haml code in
+        #tracebacks
+        setup = self.node(ast.Assign, 1,
+            targets=[self.name('HAML_file_name', 1, ast.Store)],
+            value=self.node(ast.Str, 1, s=self.filename))
+        module = ast.Module(body=[setup])
+        stack = [module.body]
+        for (i, call) in enumerate(calls):
+            del stack[call.depth + 1:]
+            body = stack[-1]
+            lineno = len(self.haml_lines)
+            self.haml_lines.append(call.haml.posinfo)
+            if call.func != None:
+                self.statement(body, self.call(call, lineno), lineno)
+            elif i + 1 < len(calls) and calls[i + 1].depth > call.depth:
+                stack.append(self.block(body, call.script.lstrip('\t'), lineno))
+            else:
+                src = call.script.lstrip('\t')
+                if src.startswith('@'):
+                    self.decorators.append(self.parse(src[1:], lineno, 'eval'))
+                    continue
+                for node in self.parse(src, lineno):
+                    self.statement(body, node, lineno)
+        if self.decorators:
+            self.error('decorator without a function', len(self.haml_lines) - 1)
+        for node in self.tries:
+            if not (node.handlers or getattr(node, 'finalbody', None)):
+                self.error('try without except or finally', node.lineno)
+        #a module made only of definitions can be executed once and reused
+        reusable = (self.context is None and
+            self.definitions(module.body[1:], set()))
+        reusable = self.node(ast.Assign, 1,
+            targets=[self.name('HAML_reusable', 1, ast.Store)],
+            value=self.name(repr(reusable), 1))
+        if self.context is not None:
+            module.body[1:] = self.function(module.body[1:])
+        module.body.insert(1, reusable)
+        return module
+
+    def definitions(self, body, bound):
+        """
+Returns whether the statements in body only define functions and classes and
+import modules, so that running them reads nothing from the render.  Default
+arguments, decorators and class bodies are evaluated when the module runs, so
+they may only read the names in bound, those of the functions and classes
+defined before them.
+        """
+        for node in body:
+            if isinstance(node, (ast.Import, ast.ImportFrom, ast.Pass)):
+                continue
+            if isinstance(node, ast.Expr) and isinstance(node.value, ast.Str):
+                #a docstring
+                continue
+            if not isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+                return False
+            evaluated = list(node.decorator_list)
+            if isinstance(node, ast.FunctionDef):
+                evaluated += node.args.defaults
+            else:
+                evaluated += node.bases
+            for expr in evaluated:
+                if not self.constant(expr, bound):
+                    return False
+            if (isinstance(node, ast.ClassDef) and
+                    not self.definitions(node.body, set(bound))):
+                return False
+            bound.add(node.name)
+        return True
+
+    def constant(self, expr, bound):
+        """
+Returns whether the expression expr reads no names but those in bound and
+True, False and None.
+        """
+        for node in ast.walk(expr):
+            if (isinstance(node, ast.Name) and
+                    node.id not in bound and
+                    node.id not in ('True', 'False', 'None')):
+                return False
+        return True
+
+    def error(self, msg, lineno, text=None, offset=None):
+        raise SyntaxError(msg, ('<haml>', lineno, offset, text))
+
+    def node(self, cls, lineno, **fields):
+        return cls(lineno=lineno, col_offset=0, **fields)
+
+    def parse(self, src, lineno, mode='exec', text=None):
+        """
+Parses a fragment of Python from the template, returning its statements (or
+its expression in 'eval' mode) located at lineno.  text is the script line
+that src was made from, for error messages.
+        """
+        try:
+            tree = ast.parse(src, '<haml>', mode)
+        except SyntaxError, ex:
+            if text is None:
+                self.error(ex.msg, lineno, src, ex.offset)
+            self.error(ex.msg, lineno, text)
+        if '\n' in (text or src):
+            #a script continued over several lines still gets a single line
+            nodes = ast.walk(tree)
+        elif mode == 'eval':
+            nodes = [tree.body]
+        else:
+            #the compiler only takes the line number of an expression if it is
+            #past its statement's, so the statements are enough
+            nodes = tree.body
+        for node in nodes:
+            if 'lineno' in node._attributes:
+                node.lineno = lineno
+        return tree.body
+
+    def name(self, id, lineno, ctx=ast.Load):
+        return self.node(ast.Name, lineno, id=id, ctx=ctx())
+
+    def function(self, body):
+        """
+Returns the statements that define and call the render function of a template
+with the given body.
+        """
+        params = ['_haml'] + ['_haml_' + func for func in self.bound]
+        params += self.context
+        args = ast.arguments(
+            args=[self.name(param, 1, ast.Param) for param in params],
+            vararg=None, kwarg=None, defaults=[])
+        ret = self.node(ast.Return, 1,
+            value=self.node(ast.Call, 1, func=self.name('locals', 1), args=[],
+                keywords=[], starargs=None, kwargs=None))
+        render = self.node(ast.FunctionDef, 1, name='HAML_render', args=args,
+            body=body + [ret], decorator_list=[])
+        values = [self.name('_haml', 1)]
+        for func in self.bound:
+            values.append(self.node(ast.Attribute, 1,
+                value=self.name('_haml', 1), attr=func, ctx=ast.Load()))
+        for name in self.context:
+            values.append(self.node(ast.Call, 1,
+                func=self.globals('get'), args=[self.node(ast.Str, 1, s=name)],
+                keywords=[], starargs=None, kwargs=None))
+        update = self.globals('update')
+        call = self.node(ast.Call, 1, func=self.name('HAML_render', 1),
+            args=values, keywords=[], starargs=None, kwargs=None)
+        return [render, self.node(ast.Expr, 1, value=self.node(ast.Call, 1,
+            func=update, args=[call], keywords=[], starargs=None, kwargs=None))]
+
+    def globals(self, attr):
+        """
+Returns the expression globals().attr.
+        """
+        return self.node(ast.Attribute, 1,
+            value=self.node(ast.Call, 1, func=self.name('globals', 1), args=[],
+                keywords=[], starargs=None, kwargs=None),
+            attr=attr, ctx=ast.Load())
+
+    def const(self, value, lineno):
+        if isinstance(value, Static):
+            return self.node(ast.Str, lineno, s=value.value)
+        elif isinstance(value, bool):
+            return self.name(repr(value), lineno)
+        return self.node(ast.Num, lineno, n=value)
+
+    def call(self, call, lineno):
+        """
+Returns the statement _haml.func(args...) for a HamlCall.
+        """
+        args = []
+        for arg in call.args:
+            if isinstance(arg, basestring):
+                args.append(self.parse(arg, lineno, 'eval'))
+            else:
+                args.append(self.const(arg, lineno))
+        if call.func in self.bound:
+            func = self.name('_haml_' + call.func, lineno)
+        else:
+            func = self.node(ast.Attribute, lineno,
+                value=self.name('_haml', lineno), attr=call.func,
+                ctx=ast.Load())
+        return self.node(ast.Expr, lineno, value=self.node(ast.Call, lineno,
+            func=func, args=args, keywords=[], starargs=None, kwargs=None))
+
+    def statement(self, body, node, lineno):
+        if self.decorators:
+            if not isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+                self.error('decorator without a function', lineno)
+            node.decorator_list = self.decorators
+            self.decorators = []
+        body.append(node)
+        self.compound.pop(id(body), None)
+
+    def block(self, body, src, lineno):
+        """
+Adds the statement for a script line that opens a block to body, returning
+the list that the statements in the block belong in.
+        """
+        inner = []
+        keyword = re.match(r'\w*', src).group()
+        if keyword in ('else', 'elif', 'except', 'finally'):
+            node = self.compound.get(id(body))
+            if node is None:
+                self.error('invalid syntax', lineno, src)
+            getattr(self, 'continue_' + keyword)(body, node, src, inner, lineno)
+            return inner
+        if keyword == 'try':
+            node = self.node(ast.TryExcept, lineno, body=inner, handlers=[],
+                orelse=[])
+            self.tries.append(node)
+        else:
+            (node,) = self.parse(src + '\n pass', lineno, text=src)
+            node.body = inner
+        self.statement(body, node, lineno)
+        self.compound[id(body)] = node
+        return inner
+
+    def continue_elif(self, body, node, src, inner, lineno):
+        if not isinstance(node, ast.If) or node.orelse:
+            self.error('invalid syntax', lineno, src)
+        (clause,) = self.parse(src[2:] + '\n pass', lineno, text=src)
+        clause.body = inner
+        node.orelse = [clause]
+        self.compound[id(body)] = clause
+
+    def continue_else(self, body, node, src, inner, lineno):
+        if node.orelse or not hasattr(node, 'orelse'):
+            self.error('invalid syntax', lineno, src)
+        self.parse(src.replace('else', 'if 1', 1) + '\n pass', lineno,
+            text=src)
+        node.orelse = inner
+        if not isinstance(node, ast.TryExcept):
+            del self.compound[id(body)]
+
+    def continue_except(self, body, node, src, inner, lineno):
+        if not isinstance(node, ast.TryExcept) or node.orelse:
+            self.error('invalid syntax', lineno, src)
+        (tree,) = self.parse('try:\n pass\n' + src + '\n pass', lineno,
+            text=src)
+        (handler,) = tree.handlers
+        handler.lineno = lineno
+        handler.body = inner
+        node.handlers.append(handler)
+
+    def continue_finally(self, body, node, src, inner, lineno):
+        if not isinstance(node, ast.TryExcept):
+            self.error('invalid syntax', lineno, src)
+        self.parse('try:\n pass\n' + src + '\n pass', lineno,
+            text=src)
+        if node.handlers:
+            clause = self.node(ast.TryFinally, lineno, body=[node],
+                finalbody=inner)
+        else:
+            clause = self.node(ast.TryFinally, lineno, body=node.body,
+                finalbody=inner)
+            self.tries.remove(node)
+        body[-1] = clause
+        del self.compound[id(body)]
+
+def generate(calls, filename, context=None):
+    """
+Returns (module, haml_lines) for a list of HamlCalls.  See CodeGenerator.
+    """
+    gen = CodeGenerator(filename, context)
+    try:
+        return (gen.generate(calls), gen.haml_lines)
+    except SyntaxError, ex:
+        ex.haml_lines = gen.haml_lines
+        raise
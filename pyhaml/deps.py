@@ -0,0 +1,91 @@
+import re
+
+#the names of the templates a Haml source imports with _haml.imp('name'),
+#import name or from name import ...
+static_imports = re.compile(r'''
+    _haml\.imp\(\s*['"]([\w.]+)['"]
+    | ^[ \t]*-[ \t]*import[ \t]+([\w., \t]+)
+    | ^[ \t]*-[ \t]*from[ \t]+([\w.]+)[ \t]+import\b
+''', re.M | re.X)
+
+def imports(src):
+    """
+Returns the names of the modules that the Haml source src imports, as far as
+can be told without running it.
+    """
+    names = []
+    for (imp, mods, frm) in static_imports.findall(src):
+        for name in (imp or frm or mods).split(','):
+            name = name.split()
+            if name and name[0] not in names:
+                names.append(name[0])
+    return names
+
+class Graph(object):
+    """
+The import edges between templates.  For every template path, deps holds the
+paths of the templates it imports and rdeps those of the templates importing
+it.  Edges are added as imports are discovered, whether found in the source or
+made while rendering.
+    """
+
+    def __init__(self):
+        self.deps = {}
+        self.rdeps = {}
+
+    def add(self, path, dep):
+        """
+Records that the template at path imports the one at dep.
+        """
+        self.deps.setdefault(path, set()).add(dep)
+        self.rdeps.setdefault(dep, set()).add(path)
+
+    def set(self, path, deps):
+        """
+Replaces the recorded imports of the template at path with deps.
+        """
+        for dep in self.deps.pop(path, ()):
+            self.rdeps[dep].discard(path)
+        for dep in deps:
+            self.add(path, dep)
+
+    def dependencies(self, path):
+        return set(self.deps.get(path, ()))
+
+    def dependents(self, path):
+        """
+Returns the paths of the templates that import the one at path, directly or
+through other templates.
+        """
+        found = set()
+        stack = [path]
+        while stack:
+            for dependent in self.rdeps.get(stack.pop(), ()):
+                if dependent not in found:
+                    found.add(dependent)
+                    stack.append(dependent)
+        found.discard(path)
+        return found
+
+    def order(self, paths):
+        """
+Returns paths sorted so that every template comes after the templates it
+imports, and otherwise in the order given.  Imports that are not in paths are
+left out.  Templates importing each other are ordered as they are first met.
+        """
+        wanted = set(paths)
+        done = set()
+        ordered = []
+        def visit(path):
+            done.add(path)
+            for dep in sorted(self.deps.get(path, ())):
+                if dep in wanted and dep not in done:
+                    visit(dep)
+            ordered.append(path)
+        for path in paths:
+            if path not in done:
+                visit(path)
+        return ordered
+
+    def __contains__(self, path):
+        return path in self.deps
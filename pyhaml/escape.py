@@ -0,0 +1,46 @@
+#longest string worth testing for each special character before replacing
+test_limit = 300
+
+class Markup(unicode):
+    """
+A string of HTML that is safe to write as is.  escape returns Markup untouched,
+and attribute values that are Markup are written without quoting.  Other
+objects with an __html__ method (like those of markupsafe) are treated the same
+way.
+    """
+
+    def __html__(self):
+        return self
+
+def escape(s):
+    """
+Escapes &, <, > and " in s for HTML text and double quoted attribute values,
+like cgi.escape(s, True).  Strings with nothing to escape are returned
+unchanged.  Objects with an __html__ method are returned as their HTML, and
+other objects that are not strings are converted with unicode first.
+    """
+    cls = type(s)
+    if cls is str:
+        return (s.replace('&', '&amp;').replace('<', '&lt;')
+            .replace('>', '&gt;').replace('"', '&quot;'))
+    if cls is not unicode:
+        if hasattr(s, '__html__'):
+            return s.__html__()
+        s = unicode(s)
+    #unicode methods convert str arguments to unicode on every call, so the
+    #unicode path uses unicode literals throughout.  On short strings the in
+    #tests are much cheaper than replace calls that find nothing, and the first
+    #character found is replaced along with the ones after it.  Long strings
+    #with nothing to escape are scanned faster by replace than by in, so they
+    #skip the tests.
+    if len(s) > test_limit or u'&' in s:
+        return (s.replace(u'&', u'&amp;').replace(u'<', u'&lt;')
+            .replace(u'>', u'&gt;').replace(u'"', u'&quot;'))
+    if u'<' in s:
+        return (s.replace(u'<', u'&lt;').replace(u'>', u'&gt;')
+            .replace(u'"', u'&quot;'))
+    if u'>' in s:
+        return s.replace(u'>', u'&gt;').replace(u'"', u'&quot;')
+    if u'"' in s:
+        return s.replace(u'"', u'&quot;')
+    return s
@@ -3,11 +3,16 @@ from __future__ import with_statement
 
 import os
 import imp
-import cgi
+import copy
 import sys
 import re
 import code
-from optparse import OptionParser
+import keyword
+import marshal
+import fnmatch
+import threading
+from string import whitespace
+from optparse import OptionParser, OptionValueError
 import logging
 import pyhaml.traceback as traceback
 
@@ -16,11 +21,84 @@ import parser
 from lexer import HamlParserException
 from parser import get_lines_in_position_range
 from ply import lex, yacc
-from patch import ex, StringIO
-from cache import Cache
+from patch import ex
+from cache import Cache, DiskCache, FragmentCache, Index, Archive
+from cache import estimate, pack_archive, placeholder, rename, sha1
+from escape import escape, Markup
+from deps import Graph, imports
+try:
+    import codegen
+except ImportError:
+    #no ast module before Python 2.6
+    codegen = None
 
 __version__ = '0.1'
 
+#fewest templates that preload compiles in a pool of processes
+pool_threshold = 32
+
+#the options that change the code a template compiles to
+compile_options = [
+    'attr_wrapper',
+    'format',
+    'escape_html',
+    'suppress_eval',
+    'preserve',
+    'autoclose',
+    'ugly',
+    'render_function',
+    'context',
+]
+
+def fingerprint(op, imported=False):
+    """
+Returns a string identifying the version of pyHaml, the registered filters and
+the compile options in op, so that compiled code is only reused with the same
+ones.  Options listing tags or names are sets, so their order does not matter.
+Templates are compiled differently to be imported, with imported true.
+    """
+    values = [__version__, imported, parser.registered]
+    for name in compile_options:
+        value = getattr(op, name)
+        if isinstance(value, list):
+            value = sorted(set(value))
+        values.append(value)
+    return repr(values)
+
+def reload_interval(reload, option='reload'):
+    """
+Converts the reload option, or another option taking the same values, to the
+interval Cache.get takes.
+    """
+    if reload == 'always':
+        return 0
+    elif reload == 'never':
+        return None
+    try:
+        return float(reload)
+    except ValueError:
+        raise OptionValueError(
+            "option %s: invalid value: %r (use always, never or a number "
+            "of seconds)" % (option, reload))
+
+#a name the context option may list
+identifier = re.compile(r'[A-Za-z_]\w*\Z')
+
+def context_names(names):
+    """
+Returns the names of the context option as str, sorted and without duplicates,
+raising OptionValueError for any that is not an identifier or starts with
+_haml.
+    """
+    checked = []
+    for name in names:
+        if (not isinstance(name, basestring) or not identifier.match(name) or
+                keyword.iskeyword(name) or name.startswith('_haml')):
+            raise OptionValueError(
+                "option context: invalid name: %r" % (name,))
+        checked.append(str(name))
+    return sorted(set(checked))
+
 class HamlException(Exception):
     """
 An exception thrown while parsing or rendering Haml.
@@ -29,20 +107,115 @@ An exception thrown while parsing or rendering Haml.
 
 class Loader(object):
 
-    def __init__(self, engine, path):
+    def __init__(self, engine, path, package=False):
         self.engine = engine
         self.path = path
+        self.package = package
 
     def load_module(self, fullname):
+        if self.package:
+            return self.engine.load_package(fullname, self.path, self)
         return self.engine.load_module(fullname, self.path, self)
 
 class Finder(object):
+    """
+The import hook that resolves .haml modules, installed in sys.meta_path once
+by install.  Imports are resolved by the engine rendering on the current
+thread, so imports made outside of renders cost a single check however many
+renders have run.
+    """
 
-    def __init__(self, engine):
-        self.engine = engine
+    def __init__(self):
+        self.local = threading.local()
 
     def find_module(self, fullname, path=None):
-        return self.engine.find_module(fullname)
+        engines = getattr(self.local, 'engines', None)
+        if not engines:
+            return None
+        return engines[-1].find_module(fullname)
+
+    def push(self, engine):
+        """
+Makes engine resolve the imports of the current thread until pop is called.
+Renders may nest, so the engines are kept on a stack.
+        """
+        engines = getattr(self.local, 'engines', None)
+        if engines is None:
+            engines = self.local.engines = []
+        engines.append(engine)
+
+    def pop(self):
+        self.local.engines.pop()
+
+finder = Finder()
+
+def install():
+    """
+Adds the template import hook to sys.meta_path, unless it is there already.
+    """
+    if finder not in sys.meta_path:
+        sys.meta_path.append(finder)
+
+def build_parser():
+    """
+Returns a Haml parser.  The LALR tables are loaded from pyhaml/parsetab.py; yacc
+checks them against the grammar signature and rewrites them if they are stale.
+    """
+    return yacc.yacc(
+        module=parser,
+        tabmodule='pyhaml.parsetab',
+        outputdir=os.path.dirname(parser.__file__),
+        debug=0)
+
+def build_lexer():
+    """
+Returns a Haml lexer.  The master regular expressions are read from
+pyhaml/lextab.py when its signature matches the rules in pyhaml/lexer.py,
+otherwise the lexer is built from the rules and the table module rewritten.
+The module is written to a temporary directory and renamed into place, so that
+other processes never import it half written.
+    """
+    signature = lexer.signature()
+    try:
+        import pyhaml.lextab as lextab
+        if lextab._lexsignature == signature:
+            lexobj = lex.Lexer()
+            lexobj.lexoptimize = 1
+            lexobj.readtab(lextab, vars(lexer))
+            return lexobj
+    except (ImportError, AttributeError, KeyError, SyntaxError):
+        pass
+    lexobj = lex.lex(module=lexer)
+    lexobj.lexoptimize = 1
+    outputdir = os.path.dirname(lexer.__file__)
+    #only needed on the rare start that rewrites the table module
+    import shutil
+    import tempfile
+    try:
+        tmpdir = tempfile.mkdtemp(dir=outputdir)
+        try:
+            lexobj.writetab('pyhaml.lextab', tmpdir)
+            tmp = os.path.join(tmpdir, 'lextab.py')
+            with open(tmp, 'a') as f:
+                f.write('_lexsignature = %r\n' % signature)
+            rename(tmp, os.path.join(outputdir, 'lextab.py'))
+        finally:
+            shutil.rmtree(tmpdir, True)
+    except (IOError, OSError):
+        pass
+    return lexobj
+
+_prototypes = None
+
+def prototypes():
+    """
+Returns the process-wide (parser, lexer) pair that every Engine is cloned from.
+The prototypes hold only the tables and are never used for parsing directly.
+    """
+    global _prototypes
+    if _prototypes is None:
+        _prototypes = (build_parser(), build_lexer())
+    return _prototypes
 
 class Engine(object):
 
@@ -72,6 +245,12 @@ class Engine(object):
         default='html5',
         dest='format')
 
+    optparser.add_option('-u', '--ugly',
+        help='do not indent the HTML',
+        action='store_true',
+        dest='ugly',
+        default=False)
+
     optparser.add_option('-e', '--escape_html',
         help='sanitize values by default',
         action='store_true',
@@ -84,12 +263,77 @@ class Engine(object):
         dest='batch',
         default=False)
 
+    optparser.add_option('-P', '--search_path',
+        help='directory to look for templates in',
+        action='append',
+        type='str',
+        dest='search_path',
+        default=[])
+
+    optparser.add_option('-A', '--archive',
+        help='zip archive of templates made with --pack to render from',
+        dest='archive')
+
+    optparser.add_option('-k', '--pack',
+        help='pack the templates under a directory into this archive',
+        dest='pack')
+
+    optparser.add_option('-I', '--index_reload',
+        help='check search_path directories for added or removed templates: '
+            'always, never or every SECONDS',
+        dest='index_reload',
+        default='1')
+
+    optparser.add_option('-L', '--access_log',
+        help='file of rendered template paths that batch compiles most '
+            'rendered first',
+        dest='access_log')
+
+    optparser.add_option('-C', '--cache_dir',
+        help='directory to keep compiled templates in between runs',
+        dest='cache_dir')
+
+    optparser.add_option('-n', '--cache_size',
+        help='most compiled templates to keep in memory',
+        type='int',
+        dest='cache_size')
+
+    optparser.add_option('-m', '--cache_bytes',
+        help='most bytes of compiled templates to keep in memory',
+        type='int',
+        dest='cache_bytes')
+
+    optparser.add_option('-S', '--string_cache_size',
+        help='most compiled to_html strings to keep in memory',
+        type='int',
+        dest='string_cache_size',
+        default=128)
+
+    optparser.add_option('-R', '--reload',
+        help='check templates for changes: always, never or every SECONDS',
+        dest='reload',
+        default='always')
+
     optparser.add_option('-s', '--suppress_eval',
         help='suppress script evaluation',
         action='store_true',
         dest='suppress_eval',
         default=False)
 
+    optparser.add_option('-r', '--render_function',
+        help='compile templates into render functions with fast locals',
+        action='store_true',
+        dest='render_function',
+        default=False)
+
+    optparser.add_option('-c', '--context',
+        help='context name read as a local by render functions, None if the '
+            'render does not set it',
+        action='append',
+        type='str',
+        dest='context',
+        default=[])
+
     optparser.add_option('-p', '--preserve',
         help='preserve whitespace tags',
         action='append',
@@ -116,19 +360,42 @@ class Engine(object):
         ])
 
     def __init__(self):
-        self._cache = Cache()
+        self._cache = Cache(on_evict=self.evict)
+        #strings given to to_html, kept apart so that they cannot push out
+        #the templates of files
+        self._strings = Cache(on_evict=self.evict)
         self.haml_line_cache = {}
-        self.parser = yacc.yacc(
-            module=parser,
-            write_tables=0,
-            debug=0)
-        self.lexer = lex.lex(module=lexer)
+        #the HTML of _haml.cached blocks, which may be replaced by any object
+        #with the same get and set methods
+        self.fragments = FragmentCache()
+        #maps (path, fingerprint) to (code, module, dependencies, definitions)
+        #for the template modules that can be reused
+        self.loaded = {}
+        #the import edges between template files
+        self.graph = Graph()
+        #the templates under the search_path roots
+        self.index = None
+        #the archive option's Archive
+        self.archive = None
+        #the clones share the tables but keep their own parse state
+        (proto_parser, proto_lexer) = prototypes()
+        self.parser = copy.copy(proto_parser)
+        self.lexer = proto_lexer.clone()
+        self.lexer.lexstatestack = []
+        install()
 
     def reset(self):
         self.depth = 0
-        self.html = StringIO()
+        self.html = []
         self.trim_next = False
+        #written before indentation, a marker instead of a newline while a
+        #fragment is captured
+        self.newline = '\n'
         self.globals = { '_haml': self }
+        #(name, previous module) for the modules this render put in sys.modules
+        self.imported = []
+        #(path, dependency list) for the modules being executed
+        self.loading = []
 
     def setops(self, *args, **kwargs):
         """
@@ -138,71 +405,309 @@ Sets options for the Haml engine.  Options should be given as keyword arguments.
         for (k,v) in kwargs.items():
             opt = Engine.optparser.get_option('--' + k)
             if opt:
-                self.op.__dict__[k] = opt.check_value(k,v)
+                #None is the default of options without one
+                if v is not None:
+                    if opt.type in ('int', 'float') and not isinstance(v,
+                            basestring):
+                        #optparse only converts strings
+                        v = str(v)
+                    v = opt.check_value(k,v)
+                self.op.__dict__[k] = v
+        self.op.context = context_names(self.op.context)
+        self.fingerprint = fingerprint(self.op)
+        self.import_fingerprint = fingerprint(self.op, True)
+        self.reload = reload_interval(self.op.reload)
+        self._cache.maxsize = self.op.cache_size
+        self._cache.maxbytes = self.op.cache_bytes
+        self._strings.maxsize = self.op.string_cache_size
+        roots = tuple(self.op.search_path)
+        if not roots:
+            self.index = None
+        elif self.index is None or self.index.roots != roots:
+            self.index = Index(roots)
+        else:
+            #once per render at most, resolving is a lookup in the index
+            self.index.refresh(
+                reload_interval(self.op.index_reload, 'index_reload'))
+        if not self.op.archive:
+            self.archive = None
+        elif (self.archive is None or
+                self.archive.path != os.path.abspath(self.op.archive)):
+            self.archive = Archive(self.op.archive)
+        elif self.archive.refresh(self.reload):
+            #a new archive was deployed
+            for (path, _) in list(self._cache.cache):
+                if self.archive.name(path) is not None:
+                    self.invalidate(path)
 
     def find_module(self, fullname):
-        dir = os.path.dirname(self.op.filename)
-        path = os.path.join(dir, '%s.haml' % fullname)
-        if os.path.exists(path):
+        path = self.resolve(fullname, self.op.filename)
+        if path is not None:
             return Loader(self, path)
+        path = self.package(fullname)
+        if path is not None:
+            return Loader(self, path, package=True)
         return None
 
-    def load_module(self, fullname, path, loader):
-        code = self.cache(path)
+    def package(self, fullname):
+        """
+Returns the path of the directory that fullname names under the search_path
+roots or in the archive, or None.  Such a directory is imported as a package,
+so that import a.b works for the template a/b.haml.
+        """
+        name = fullname.replace('.', '/')
+        path = self.index and self.index.packages.get(name)
+        if (path is None and self.archive is not None and
+                name in self.archive.dirs):
+            path = self.archive.prefix + name.replace('/', os.sep)
+        return path
+
+    def load_package(self, fullname, path, loader):
+        """
+Returns an empty package for the template directory at path, imported as
+fullname.  Like template modules, it is only in sys.modules until the render
+ends.
+        """
         mod = imp.new_module(fullname)
-        mod = sys.modules.setdefault(fullname, mod)
         mod.__file__ = path
+        mod.__path__ = [path]
         mod.__loader__ = loader
+        self.imported.append((fullname, sys.modules.get(fullname)))
+        sys.modules[fullname] = mod
+        return mod
+
+    def resolve(self, fullname, filename):
+        """
+Returns the path of the template that filename imports as fullname, or None if
+there is none.  The directory of filename is looked in first, then the
+search_path roots and the archive, where a.b names a/b.haml.  filename is None
+for strings, which only import from the roots and the archive.  Directories
+under a root are looked in with the index rather than the filesystem.
+        """
+        index = self.index
+        archive = self.archive
+        if filename is not None:
+            dir = os.path.dirname(filename)
+            path = os.path.join(dir, '%s.haml' % fullname)
+            name = archive and archive.name(path)
+            if name:
+                if name in archive:
+                    return path
+            elif index is not None and dir in index.dirs:
+                if path in index:
+                    return path
+            elif (self._cache.peek((path, self.fingerprint), self.reload)
+                    != None or os.path.exists(path)):
+                return path
+        name = fullname.replace('.', '/') + '.haml'
+        path = index and index.find(name)
+        if path is None and archive is not None and name in archive:
+            path = archive.prefix + name.replace('/', os.sep)
+        return path
+
+    def scan(self, filename, src=None):
+        """
+Records in self.graph the templates that filename imports according to its
+source src, which is read from the file if None.
+        """
+        if src is None:
+            with open(filename) as haml:
+                src = haml.read()
+        deps = [self.resolve(name, filename) for name in imports(src)]
+        self.graph.set(filename, [dep for dep in deps if dep is not None])
+
+    def dependents(self, filename):
+        """
+Returns the paths of the templates known to import filename, directly or
+through other templates.
+        """
+        return self.graph.dependents(filename)
+
+    def load_module(self, fullname, path, loader):
+        """
+Returns the module for the template at path, imported as fullname.  A module
+whose top level only defines functions and classes and imports modules is
+executed once and reused for as long as the code of its template and of the
+templates it imported stay the same.  Any other module is executed on every
+import, since its top level may read the render's globals.  The globals of a
+module are those of the current render plus the names the template defined,
+and it is only in sys.modules until the render ends, so no render sees the
+context of another.
+
+Imported templates are compiled with their own fingerprint, so that their top
+level writes at the depth of the importer.
+        """
+        key = (path, self.import_fingerprint)
+        if self.loading:
+            (importer, deps) = self.loading[-1]
+            deps.append(key)
+        else:
+            importer = self.op.filename
+        if importer is not None:
+            self.graph.add(importer, path)
+        self.imported.append((fullname, sys.modules.get(fullname)))
+        (fingerprint, self.fingerprint) = (self.fingerprint, key[1])
+        try:
+            mod = self.reuse(key)
+            if mod is None:
+                mod = imp.new_module(fullname)
+                mod.__file__ = path
+                mod.__loader__ = loader
+                #in sys.modules while it runs, like any module
+                sys.modules[fullname] = mod
+                self.run(key, mod)
+        finally:
+            self.fingerprint = fingerprint
+        sys.modules[fullname] = mod
+        return mod
+
+    def run(self, key, mod):
+        """
+Executes the template module for key = (path, fingerprint) in mod, and keeps
+it for reuse if its template says it is reusable.
+        """
+        code = self.cache(key[0])
+        mod.__dict__.update(self.globals)
+        #the line map of errors in the module is kept under its fingerprint
+        mod.__dict__['HAML_fingerprint'] = key[1]
+        deps = []
+        self.loading.append((key[0], deps))
+        try:
+            ex(code, mod.__dict__)
+        finally:
+            self.loading.pop()
+        if mod.__dict__.get('HAML_reusable'):
+            defined = dict((k, v) for (k, v) in mod.__dict__.iteritems()
+                if k not in self.globals or self.globals[k] is not v)
+            self.loaded[key] = (code, mod, deps, defined)
+
+    def reuse(self, key):
+        """
+Returns the kept module for key = (path, fingerprint) with its globals set for
+the current render, or None if the module has to be executed again because it
+or a template it imported changed.
+        """
+        entry = self.loaded.get(key)
+        if entry is None:
+            return None
+        (code, mod, deps, defined) = entry
+        if self.cache(key[0]) is not code:
+            return None
+        for dep in deps:
+            if self.reuse(dep) is None:
+                return None
+        mod.__dict__.clear()
         mod.__dict__.update(self.globals)
-        ex(code, mod.__dict__)
+        mod.__dict__.update(defined)
         return mod
 
+    def unimport(self):
+        """
+Takes the modules imported by the render out of sys.modules again.
+        """
+        for (name, prev) in reversed(self.imported):
+            if prev is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = prev
+        del self.imported[:]
+
     def imp(self, fullname):
-        finder = Finder(self)
-        loader = finder.find_module(fullname)
+        loader = self.find_module(fullname)
         if loader:
             return loader.load_module(fullname)
         return None
 
-    def entab(self):
-        self.depth += 1
+    def entab(self, n=1):
+        self.depth += n
 
-    def detab(self):
-        self.depth -= 1
+    def detab(self, n=1):
+        self.depth -= n
 
     def trim(self):
         self.trim_next = True
 
+    def untrim(self):
+        self.trim_next = False
+
     def indent(self, indent):
         if not self.trim_next:
-            self.write('\n')
             if indent:
-                self.write('  ' * self.depth)
+                self.write(self.newline, '  ' * self.depth)
+            else:
+                self.write('\n')
         self.trim_next = False
 
+    def cached(self, name, key=None, ttl=None):
+        """
+Caches the HTML written by a block in self.fragments under name and key, for
+ttl seconds or until it is evicted.  The block is written as
+
+- with _haml.cached('nav', user.id, ttl=60):
+  %ul ...
+
+which is compiled to a for loop over this generator.  On a miss it yields once
+to run the body, capturing its HTML, and on a hit it yields nothing so the body
+is skipped.  Either way the fragment is then written.
+
+The body is captured at depth 0 with a marker for each newline that is
+followed by indentation, and the markers are replaced with the indentation of
+the current depth when the fragment is written, so a fragment can be replayed
+at any depth.
+        """
+        #the output of the block depends on the options and whether its first
+        #indent is trimmed
+        fkey = (name, key, self.fingerprint, self.trim_next)
+        fragment = self.fragments.get(fkey)
+        if fragment is None:
+            state = (self.html, self.depth, self.newline)
+            (self.html, self.depth, self.newline) = ([], 0, '\0')
+            try:
+                yield
+                fragment = (''.join(self.html), self.trim_next)
+            finally:
+                (self.html, self.depth, self.newline) = state
+            self.fragments.set(fkey, fragment, ttl)
+        (html, self.trim_next) = fragment
+        self.write(html.replace('\0', self.newline + '  ' * self.depth))
+
     def write(self, *args):
-        for arg in args:
-            arg = arg.encode("ascii", "xmlcharrefreplace")
-            self.html.write(arg)
+        self.html.extend(args)
+
+    def output(self):
+        """
+Returns the written HTML with the surrounding whitespace stripped and a newline
+at the end.  The chunks are joined once, and the document is encoded once if it
+is unicode.
+        """
+        html = self.html
+        #strip the ends chunk by chunk instead of copying the whole document
+        while html and not html[-1].rstrip(whitespace):
+            html.pop()
+        if html:
+            html[-1] = html[-1].rstrip(whitespace)
+            #stops at the last chunk at the latest, which is not blank
+            start = 0
+            while not html[start].lstrip(whitespace):
+                start += 1
+            html[start] = html[start].lstrip(whitespace)
+            del html[:start]
+        html.append('\n')
+        html = ''.join(html)
+        if not isinstance(html, str):
+            html = html.encode('ascii', 'xmlcharrefreplace')
+        return html
+
+    escape = staticmethod(escape)
 
-    def escape(self, string):
-        return cgi.escape(string, True)
+    #templates mark HTML as safe from escaping with _haml.safe(html)
+    safe = Markup
 
     def preserve_whitespace(self, string):
         return string.replace('\n', '&#x000A;')
 
     def attrs(self, id, klass, a):
-        a = dict((k,v) for k,v in a.items() if v != None)
-        if id:
-            a['id'] = id + '_' + a.get('id','') if 'id' in a else id
-        if klass:
-            a['class'] = (klass + ' ' + a.get('class','')).strip()
-        w = self.op.attr_wrapper
-        for k,v in a.items():
-            if v is None or v is False: continue
-            if v is True: v = k # for things like checked=checked
-            v = unicode(v).replace(w, {'"':'&quot;', "'":'&#39;'}[w])
-            self.write(' %s=%s%s%s' % (k,w,v,w))
+        self.write(parser.format_attrs(id, klass, a, self.op.attr_wrapper))
 
     def compile(self, s, filename="<string>"):
         """
@@ -219,6 +724,7 @@ code, which helps give better error messages.
             'to_close': [],
             'preserve': 0,
             'lineno': 1,
+            'relative': self.fingerprint == self.import_fingerprint,
         })
 
         self.lexer.begin('INITIAL')
@@ -241,27 +747,23 @@ code, which helps give better error messages.
             raise HamlException, (-1, "HAML error",
                 "Parse error in file %r: %s at line %d:\n%s\n%s" %
 (filename, msg, lineno, haml_line, traceback.format_exc(with_vars=True)))
-        #add a line too the beginning of the Python source indicating which
-        #Haml file this is.  This can be accessed later for getting descriptive
-        #error messages.
-        lines = ["HAML_file_name = %r" % filename]
-        #haml_lines maps Python lines to Haml (line number, code) pairs.
-        haml_lines = [(0, "<no line 0>"), (0, "<HAML setup>")]
-        for call in self.parser.src:
-            line = str(call)
-            lines.append(line)
-            haml_line = call.haml.posinfo
-            #append once for every Python line this Haml call turned into
-            for i in range(1 + line.count('\n')):
-                haml_lines.append(haml_line)
-        self.haml_line_cache[filename] = haml_lines
-        src = '\n'.join(lines) + '\n'
         try:
+            if codegen is None:
+                return self.compile_source(filename)
+            context = None
+            if self.op.render_function:
+                context = self.op.context
+            (tree, haml_lines) = codegen.generate(self.parser.src, filename,
+                context)
+            self.haml_line_cache[(filename, self.fingerprint)] = haml_lines
             #important for file to be "<haml>" so execute() can detect Haml
             #code in tracebacks
-            return code.compile_command(src, "<haml>", "exec")
+            return compile(tree, "<haml>", "exec")
         except SyntaxError:
             exc_type, exc_value, exc_traceback = sys.exc_info()
+            if hasattr(exc_value, 'haml_lines'):
+                self.haml_line_cache[(filename, self.fingerprint)] = \
+                    exc_value.haml_lines
             haml_line_number, haml_line = self.get_haml_line_info(filename,
 exc_value.lineno, exc_value.text)
             #change the syntax error message to show the Haml code
@@ -272,15 +774,40 @@ exc_value.lineno, exc_value.text)
             message[1] = '    %s\n  Python:\n%s' % (haml_line, message[1])
             raise HamlException(-1, "HAML error", ''.join(message))
 
+    def compile_source(self, filename):
+        """
+Compiles the parsed HamlCalls by way of Python source text, for Pythons
+without the ast module.  The render_function option has no effect here.
+        """
+        #add a line too the beginning of the Python source indicating which
+        #Haml file this is.  This can be accessed later for getting descriptive
+        #error messages.
+        lines = ["HAML_file_name = %r" % filename]
+        #haml_lines maps Python lines to Haml (line number, code) pairs.
+        haml_lines = [(0, "<no line 0>"), (0, "<HAML setup>")]
+        for call in self.parser.src:
+            line = str(call)
+            lines.append(line)
+            haml_line = call.haml.posinfo
+            #append once for every Python line this Haml call turned into
+            for i in range(1 + line.count('\n')):
+                haml_lines.append(haml_line)
+        self.haml_line_cache[(filename, self.fingerprint)] = haml_lines
+        src = '\n'.join(lines) + '\n'
+        return code.compile_command(src, "<haml>", "exec")
+
     def get_haml_line_info(self, haml_file_name, python_line_number,
-                           python_text="<unknown Python>"):
+                           python_text="<unknown Python>", fingerprint=None):
         """
 Given a Haml file name and Python line number, figure out what Haml code in the
-file produced the Python line.  Returns pair (Haml line number, Haml code).
+file produced the Python line when compiled with the current options.  Returns
+pair (Haml line number, Haml code).
 Optional python_text argument specifies the Python code that caused the error,
-which is used in case the Haml line can't be found.
+which is used in case the Haml line can't be found.  Optional fingerprint is
+the one the file was compiled with, if not the current options'.
         """
-        haml_lines = self.haml_line_cache.get(haml_file_name, [])
+        haml_lines = self.haml_line_cache.get(
+            (haml_file_name, fingerprint or self.fingerprint), [])
         if python_line_number < len(haml_lines):
             return haml_lines[python_line_number]
         else:
@@ -298,20 +825,20 @@ traceback.
             self.globals.update(args[0])
         if self.op.debug:
             sys.stdout.write(src)
-        finder = Finder(self)
-        sys.meta_path.append(finder)
+        finder.push(self)
         try:
             ex(src, self.globals)
-            return self.html.getvalue().strip() + '\n'
+            return self.output()
         except:
             exc_type, exc_value, exc_traceback = sys.exc_info()
             tb = traceback.extract_tb(exc_traceback)
             for i, (python_file_name, python_line_number, function_name, python_text, local) in enumerate(tb):
                 if python_file_name == "<haml>":
-                    haml_file_name = exc_traceback.tb_frame.f_globals.get(
-                        "HAML_file_name", "<string>")
+                    f_globals = exc_traceback.tb_frame.f_globals
+                    haml_file_name = f_globals.get("HAML_file_name", "<string>")
                     haml_line_number, haml_line = self.get_haml_line_info(
-                        haml_file_name, python_line_number, python_text)
+                        haml_file_name, python_line_number, python_text,
+                        f_globals.get("HAML_fingerprint"))
                     tb[i] = (haml_file_name, haml_line_number, function_name,
                              haml_line, local)
                 exc_traceback = exc_traceback.tb_next
@@ -319,18 +846,213 @@ traceback.
             formatted += traceback.format_list(tb, with_vars=True)
             formatted += traceback.format_exception_only(exc_type, exc_value)
             raise HamlException, (-1, "HAML error", "".join(formatted))
-        # finally:
-        #     sys.meta_path.remove(finder)
+        finally:
+            finder.pop()
+            self.unimport()
 
     def cache(self, filename):
         """
 Given a Haml filename, returns a Python code object that generates the HTML for
-that Haml file.  This uses a cache so the same file isn't compiled twice.
+that Haml file.  This uses a cache so the same file isn't compiled twice with
+the same options.
         """
-        if not filename in self._cache:
-            with open(filename) as haml:
-                self._cache[filename] = self.compile(haml.read(), filename)
-        return self._cache[filename]
+        key = (filename, self.fingerprint)
+        name = self.archive and self.archive.name(filename)
+        if name:
+            #setops reopens the archive when it changes
+            code = self._cache.get(key, None)
+            if code is None:
+                code = self.unpack(filename, name)
+                #there is no file to take the modification time of
+                self._cache.set(key, code, 0,
+                    estimate(code, self.haml_line_cache[key]))
+            return code
+        code = self._cache.get(key, self.reload)
+        if code is None:
+            stat = os.stat(filename)
+            code = self.load(filename, stat)
+            self._cache.set(key, code, stat.st_mtime,
+                estimate(code, self.haml_line_cache[key]))
+        return code
+
+    def evict(self, key):
+        """
+Called when the compiled template for key = (filename, fingerprint) leaves the
+cache, or the string for key = (filename, fingerprint, digest).  Drops its line
+map and the module it was executed in.
+        """
+        self.haml_line_cache.pop(key[:2], None)
+        self.loaded.pop(key, None)
+
+    def stats(self, strings=False):
+        """
+Returns the template cache's counters: hits, misses, evictions, entries and
+bytes.  With strings true, returns those of the to_html string cache instead.
+        """
+        if strings:
+            return self._strings.stats()
+        return self._cache.stats()
+
+    def invalidate(self, filename=None):
+        """
+Makes the next render of filename, or of every file if filename is None,
+check whether the file changed whatever the reload option says.  The
+templates that import filename are invalidated as well.
+        """
+        self._cache.invalidate(filename)
+        if filename is not None:
+            for dependent in self.graph.dependents(filename):
+                self._cache.invalidate(dependent)
+
+    def load(self, filename, stat):
+        """
+Returns the code object for a Haml file.  If the cache_dir option is set and
+holds an entry for the file that is still valid, the code is loaded from there,
+otherwise the file is compiled and the entry written.  stat is the result of
+os.stat for the file, taken before reading it.
+        """
+        disk = None
+        if self.op.cache_dir:
+            disk = DiskCache(self.op.cache_dir)
+            entry = disk.load(filename, self.fingerprint, stat)
+            if entry is not None:
+                (code, haml_lines) = entry
+                self.haml_line_cache[(filename, self.fingerprint)] = haml_lines
+                return code
+        with open(filename) as haml:
+            src = haml.read()
+        code = self.compile(src, filename)
+        self.scan(filename, src)
+        if disk:
+            disk.store(filename, self.fingerprint, code,
+                self.haml_line_cache[(filename, self.fingerprint)], stat)
+        return code
+
+    def unpack(self, filename, name):
+        """
+Returns the code object for the template called name in the archive, at path
+filename.  The code in the archive is used if it was compiled with the current
+options, otherwise the source is compiled.
+        """
+        entry = self.archive.load(name, self.fingerprint, filename)
+        if entry is not None:
+            (code, haml_lines) = entry
+            self.haml_line_cache[(filename, self.fingerprint)] = haml_lines
+            return code
+        src = self.archive.read(name)
+        code = self.compile(src, filename)
+        self.scan(filename, src)
+        return code
+
+    def pack(self, dest, root, pattern='*.haml', **kwargs):
+        """
+Writes the templates under the directory root whose name matches pattern to
+the zip archive dest, with their code compiled with the given options, for
+rendering with the archive option.  dest is replaced atomically, so it can be
+the archive being rendered from.  Each template is compiled both to be rendered
+and to be imported.  Templates that fail to compile are stored as source only,
+and a dictionary mapping them to the exceptions raised is returned.
+        """
+        self.setops(**kwargs)
+        page = self.fingerprint
+        templates = []
+        failures = {}
+        for f in find_templates(root, pattern):
+            name = f[len(os.path.join(root, '')):].replace(os.sep, '/')
+            #the archive sets the path the template is loaded from
+            filename = placeholder(name)
+            with open(f) as haml:
+                src = haml.read()
+            compiled = []
+            try:
+                for fingerprint in (page, self.import_fingerprint):
+                    self.fingerprint = fingerprint
+                    code = self.compile(src, filename)
+                    haml_lines = self.haml_line_cache.pop(
+                        (filename, self.fingerprint))
+                    compiled.append((self.fingerprint, code, haml_lines))
+            except HamlException, exc_value:
+                failures[f] = exc_value
+                compiled = []
+            finally:
+                self.fingerprint = page
+            templates.append((name, src, compiled))
+        pack_archive(dest, templates)
+        return failures
+
+    def preload(self, root, pattern='*.haml', log=None, processes=None,
+            **kwargs):
+        """
+Compiles every template under the directory root whose name matches pattern
+into the cache, so that renders after startup or after forking workers find
+them compiled.  Options are given as keyword arguments, as for render, and
+with the cache_dir option the compiled templates are kept there as well.
+
+log is an iterable of rendered template paths, relative to root or absolute,
+such as the lines of an access log.  The most rendered templates are compiled
+first, each after the templates it imports, and they are kept if the cache
+cannot hold every template.  Templates imported by others are compiled to be
+imported as well.
+
+More than pool_threshold templates are compiled by a pool of processes (one
+per CPU if processes is None), which send the code back marshalled.  Returns a
+dictionary mapping the templates that could not be compiled to the exceptions
+raised.
+        """
+        self.setops(**kwargs)
+        files = find_templates(root, pattern)
+        counts = {}
+        for path in log or ():
+            path = os.path.normpath(os.path.join(root, path.strip()))
+            counts[path] = counts.get(path, 0) + 1
+        files.sort(key=lambda f: -counts.get(os.path.normpath(f), 0))
+        for f in files:
+            if f not in self.graph:
+                try:
+                    self.scan(f)
+                except EnvironmentError:
+                    pass
+        jobs = []
+        for f in self.graph.order(files):
+            if self.graph.rdeps.get(f):
+                jobs.append((f, True))
+            jobs.append((f, False))
+        if self.op.cache_size is not None:
+            del jobs[self.op.cache_size:]
+        Pool = None
+        if processes != 1 and len(jobs) > pool_threshold:
+            #multiprocessing is slow to import and only needed here
+            try:
+                from multiprocessing.pool import Pool
+            except ImportError:
+                #no multiprocessing before Python 2.6
+                pass
+        if Pool is None:
+            results = [compile_template(self, f, imported)
+                for (f, imported) in jobs]
+        else:
+            pool = Pool(processes)
+            try:
+                results = pool.map(preload_worker,
+                    [(f, imported, self.op.__dict__) for (f, imported) in jobs],
+                    1)
+            finally:
+                pool.close()
+                pool.join()
+        failures = {}
+        #set the least rendered first, so that the cache evicts them first
+        for ((filename, imported), (_, result)) in reversed(zip(jobs, results)):
+            if isinstance(result, Exception):
+                failures[filename] = result
+                continue
+            (code, haml_lines, mtime) = result
+            if isinstance(code, str):
+                code = marshal.loads(code)
+            key = (filename, imported and self.import_fingerprint or
+                self.fingerprint)
+            self.haml_line_cache[key] = haml_lines
+            self._cache.set(key, code, mtime, estimate(code, haml_lines))
+        return failures
 
     def to_html(self, s, *args, **kwargs):
         """
@@ -340,16 +1062,96 @@ Converts Haml code to its corresponding HTML.
         if s == '':
             return ''
         self.setops(*args, **kwargs)
-        return self.execute(self.compile(s), *args)
+        return self.execute(self.cache_string(s), *args)
+
+    def cache_string(self, s):
+        """
+Returns the code object for the Haml string s, compiling it only if it has not
+been compiled with the same options before.  Strings are told apart by their
+type and the SHA-1 digest of their contents, the start of which names them in
+error messages.  A unicode string and its UTF-8 encoding compile differently.
+        """
+        if isinstance(s, unicode):
+            digest = sha1(s.encode('utf-8')).hexdigest()
+            filename = '<unicode string %s>' % digest[:12]
+        else:
+            digest = sha1(s).hexdigest()
+            filename = '<string %s>' % digest[:12]
+        key = (filename, self.fingerprint, digest)
+        #strings never change, so the entry is never checked
+        code = self._strings.get(key, None)
+        if code is None:
+            code = self.compile(s, filename)
+            self._strings.set(key, code, 0,
+                estimate(code, self.haml_line_cache[key[:2]]))
+        return code
 
     def render(self, filename, *args, **kwargs):
         """
-Renders HTML from a Haml file.
+Renders HTML from a Haml file.  With the search_path or archive option,
+filename may also name a template relative to one of the roots or in the
+archive, like layouts/base.haml.
         """
         self.setops(filename=filename, *args, **kwargs)
+        path = None
+        if self.index is not None:
+            path = self.index.find(filename)
+        if (path is None and self.archive is not None and
+                filename in self.archive):
+            path = self.archive.prefix + filename.replace('/', os.sep)
+        if path is not None:
+            filename = self.op.filename = path
         src = self.cache(filename)
         return self.execute(src, filename=filename, *args)
 
+def find_templates(root, pattern='*.haml'):
+    """
+Returns the paths of the files under the directory root whose name matches
+pattern, in a stable order.
+    """
+    files = []
+    for (dir, dirs, names) in os.walk(root):
+        dirs.sort()
+        for name in sorted(fnmatch.filter(names, pattern)):
+            files.append(os.path.join(dir, name))
+    return files
+
+def compile_template(engine, filename, imported=False):
+    """
+Compiles a template for preload, to be imported if imported is true, returning
+(filename, (code, haml_lines, mtime)) or (filename, the exception raised).
+    """
+    page = engine.fingerprint
+    if imported:
+        engine.fingerprint = engine.import_fingerprint
+    try:
+        stat = os.stat(filename)
+        code = engine.load(filename, stat)
+        haml_lines = engine.haml_line_cache[(filename, engine.fingerprint)]
+    except (EnvironmentError, HamlException), exc_value:
+        return (filename, exc_value)
+    finally:
+        engine.fingerprint = page
+    return (filename, (code, haml_lines, stat.st_mtime))
+
+#the engine of a preload worker process
+worker = None
+
+def preload_worker((filename, imported, ops)):
+    """
+Compiles a template in a preload worker process, with the code marshalled to
+send it back.
+    """
+    global worker
+    if worker is None:
+        worker = Engine()
+    worker.setops(**ops)
+    (filename, result) = compile_template(worker, filename, imported)
+    if isinstance(result, Exception):
+        return (filename, result)
+    (code, haml_lines, mtime) = result
+    return (filename, (marshal.dumps(code), haml_lines, mtime))
+
 eng = Engine()
 setops = eng.setops
 to_html = eng.to_html
@@ -358,14 +1160,32 @@ render = eng.render
 if __name__ == '__main__':
     (op, args) = Engine.optparser.parse_args(sys.argv[1:])
 
-    if op.batch:
-        eng.setops(**op.__dict__)
-        for p in (s for s in args if s.endswith('.haml')):
-            eng.cache(p)
+    if op.pack:
+        failures = eng.pack(op.pack, args[0], **op.__dict__)
+        for (p, exc_value) in sorted(failures.items()):
+            sys.stderr.write('%s: %s\n' % (p, exc_value.args[-1]))
+        sys.exit(failures and 1 or 0)
+    elif op.batch:
+        log = None
+        if op.access_log:
+            with open(op.access_log) as f:
+                log = f.readlines()
+        failures = {}
+        for p in args:
+            if os.path.isdir(p):
+                failures.update(eng.preload(p, log=log, **op.__dict__))
+            elif p.endswith('.haml'):
+                eng.setops(**op.__dict__)
+                eng.cache(p)
+        for (p, exc_value) in sorted(failures.items()):
+            sys.stderr.write('%s: %s\n' % (p, exc_value.args[-1]))
+        sys.exit(failures and 1 or 0)
     else:
         if not len(args):
             s = to_html(sys.stdin.read(), **op.__dict__)
         else:
+            #the file to render is given as an argument
+            del op.filename
             s = render(args[0], **op.__dict__)
 
         sys.stdout.write(s)
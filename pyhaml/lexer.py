@@ -56,6 +56,29 @@ def build(self, **kwargs):
     self.lexer.block = None
     return self
 
+def signature():
+    """Returns a digest of the token rules, used to detect a stale lextab."""
+    try:
+        from hashlib import md5
+    except ImportError:
+        from md5 import md5
+    sig = md5()
+    sig.update(repr((tokens, states, literals)).encode('latin-1'))
+    rules = []
+    for name, rule in globals().items():
+        if not name.startswith('t_'):
+            continue
+        #PLY orders function rules by line number, so their order matters too
+        line = 0
+        if callable(rule):
+            line = rule.func_code.co_firstlineno
+            rule = rule.__doc__
+        rules.append((line, name, rule))
+    rules.sort()
+    for _, name, rule in rules:
+        sig.update(('%s %s\n' % (name, rule)).encode('latin-1'))
+    return sig.hexdigest()
+
 def pytokens(t):
     """Splits the string starting at t's position into Python tokens, yielding them."""
     try:
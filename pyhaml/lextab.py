@@ -0,0 +1,10 @@
+# pyhaml.lextab.py. This file automatically created by PLY (version 3.3). Don't edit!
+_tabversion   = '3.3'
+_lextokens    = {'LF': 1, 'TRIM': 1, 'COMMENT': 1, 'FILTER': 1, 'HTMLTYPE': 1, 'SCRIPT': 1, 'XMLTYPE': 1, 'DOCTYPE': 1, 'VALUE': 1, 'CLASSNAME': 1, 'DICT': 1, 'SILENTSCRIPT': 1, 'TAGNAME': 1, 'FILTERCONTENT': 1, 'FILTERBLANKLINES': 1, 'CONDCOMMENT': 1, 'ID': 1}
+_lexreflags   = 0
+_lexliterals  = '":,{}<>/'
+_lexstateinfo = {'comment': 'exclusive', 'multi': 'exclusive', 'silent': 'exclusive', 'tabs': 'exclusive', 'INITIAL': 'inclusive', 'doctype': 'exclusive', 'filter': 'exclusive', 'tag': 'exclusive'}
+_lexstatere   = {'comment': [('(?P<t_tag_doctype_comment_INITIAL_LF>\\s*\\n([\\s]*\\n)?)|(?P<t_comment_VALUE>[^\\n]+)', [None, ('t_tag_doctype_comment_INITIAL_LF', 'LF'), None, ('t_comment_VALUE', 'VALUE')])], 'multi': [('(?P<t_multi_newline>\\n([\\s]*\\n)?)|(?P<t_multi_VALUE>[^\\n]+)', [None, ('t_multi_newline', 'newline'), None, ('t_multi_VALUE', 'VALUE')])], 'silent': [('(?P<t_silent_LF>\\n([\\s]*\\n)?)|(?P<t_silent_other>[^\\n]+)', [None, ('t_silent_LF', 'LF'), None, ('t_silent_other', 'other')])], 'tabs': [('(?P<t_tabs_other>[^ \\t])|(?P<t_tabs_indent>[ \\t]+)', [None, ('t_tabs_other', 'other'), ('t_tabs_indent', 'indent')])], 'INITIAL': [('(?P<t_tag_doctype_comment_INITIAL_LF>\\s*\\n([\\s]*\\n)?)|(?P<t_silentcomment>-\\#[^\\n]*)|(?P<t_DOCTYPE>!!!)|(?P<t_VALUE>[^:=&/#!.%~\\n\\t -][^\\n]*)|(?P<t_CONDCOMMENT>/\\[[^\\]]+\\])|(?P<t_COMMENT>/)|(?P<t_TAGNAME>%[a-zA-Z][a-zA-Z0-9-:_]*)|(?P<t_tag_INITIAL_ID>\\#[a-zA-Z][a-zA-Z0-9-_]*)|(?P<t_tag_INITIAL_CLASSNAME>\\.[a-zA-Z-][a-zA-Z0-9-_]*)|(?P<t_SILENTSCRIPT>-)|(?P<t_tag_INITIAL_SCRIPT>[ ]*(\\~|(&|!)?=))|(?P<t_script_SCRIPT>=)|(?P<t_FILTER>:[^\\n]+)', [None, ('t_tag_doctype_comment_INITIAL_LF', 'LF'), None, ('t_silentcomment', 'silentcomment'), ('t_DOCTYPE', 'DOCTYPE'), ('t_VALUE', 'VALUE'), ('t_CONDCOMMENT', 'CONDCOMMENT'), ('t_COMMENT', 'COMMENT'), ('t_TAGNAME', 'TAGNAME'), ('t_tag_INITIAL_ID', 'ID'), ('t_tag_INITIAL_CLASSNAME', 'CLASSNAME'), ('t_SILENTSCRIPT', 'SILENTSCRIPT'), ('t_tag_INITIAL_SCRIPT', 'SCRIPT'), None, None, ('t_script_SCRIPT', 'script_SCRIPT'), ('t_FILTER', 'FILTER')])], 'doctype': [('(?P<t_tag_doctype_comment_INITIAL_LF>\\s*\\n([\\s]*\\n)?)|(?P<t_doctype_XMLTYPE>[ ]+XML([ ]+[^\\n]+)?)|(?P<t_doctype_HTMLTYPE>[ ]+(strict|frameset|mobile|basic|transitional))', [None, ('t_tag_doctype_comment_INITIAL_LF', 'LF'), None, ('t_doctype_XMLTYPE', 'XMLTYPE'), None, ('t_doctype_HTMLTYPE', 'HTMLTYPE')])], 'filter': [('(?P<t_filter_FILTERBLANKLINES>\\n([\\s]*\\n)*)|(?P<t_filter_FILTERCONTENT>[^\\n]+)', [None, ('t_filter_FILTERBLANKLINES', 'FILTERBLANKLINES'), None, ('t_filter_FILTERCONTENT', 'FILTERCONTENT')])], 'tag': [('(?P<t_tag_doctype_comment_INITIAL_LF>\\s*\\n([\\s]*\\n)?)|(?P<t_tag_INITIAL_ID>\\#[a-zA-Z][a-zA-Z0-9-_]*)|(?P<t_tag_INITIAL_CLASSNAME>\\.[a-zA-Z-][a-zA-Z0-9-_]*)|(?P<t_tag_DICT>[ ]*{)|(?P<t_tag_INITIAL_SCRIPT>[ ]*(\\~|(&|!)?=))|(?P<t_tag_TRIM><>|><|<|>)|(?P<t_tag_VALUE>[ \\t]*[^{}<>=&/#!.%~\\n\\t -][^\\n]*)', [None, ('t_tag_doctype_comment_INITIAL_LF', 'LF'), None, ('t_tag_INITIAL_ID', 'ID'), ('t_tag_INITIAL_CLASSNAME', 'CLASSNAME'), ('t_tag_DICT', 'DICT'), ('t_tag_INITIAL_SCRIPT', 'SCRIPT'), None, None, ('t_tag_TRIM', 'TRIM'), ('t_tag_VALUE', 'VALUE')])]}
+_lexstateignore = {'comment': '\r', 'multi': '\r', 'silent': '\r', 'tabs': '\r', 'INITIAL': '\r', 'doctype': '\r', 'filter': '\r', 'tag': '\r'}
+_lexstateerrorf = {'comment': 't_ANY_error', 'multi': 't_ANY_error', 'silent': 't_ANY_error', 'tabs': 't_ANY_error', 'INITIAL': 't_ANY_error', 'doctype': 't_ANY_error', 'filter': 't_ANY_error', 'tag': 't_ANY_error'}
+_lexsignature = 'b3169e7559c63ca4b0623311927a5eea'
@@ -1,7 +1,26 @@
+import re
 import sys
 from lexer import tokens, HamlParserException
 from patch import toks, untokenize
-import markdown
+from escape import escape as escape_html
+
+#a with block over _haml.cached, which is run as a for loop since the body of a
+#with statement cannot be skipped.  The name after as, if any, is bound to None.
+cached_with = re.compile(r'''(\s*)with\s+(_haml\.cached\(.*\))
+    (?:\s+as\s+([A-Za-z_]\w*))?\s*:\s*(?:\#.*)?$''', re.S | re.X)
+
+#any other with statement over _haml.cached, which would fail at runtime
+other_cached_with = re.compile(r'\s*with\b.*\b_haml\.cached\(', re.S)
+
+#script lines opening blocks whose bodies run at a depth only known at runtime
+relative_block = re.compile(r'\s*(def\b|for\s+\w+\s+in\s+_haml\.cached\()')
+
+try:
+    from ast import literal_eval
+except ImportError:
+    #before Python 2.6 calling literal_eval raises TypeError, which its callers
+    #catch to fall back to evaluating the value when the template runs
+    literal_eval = None
 
 doctypes = {
     'xhtml': {
@@ -38,6 +57,45 @@ doctypes = {
 doctypes['xhtml'][''] = doctypes['xhtml']['transitional']
 doctypes['html4'][''] = doctypes['html4']['transitional']
 
+def constant(s):
+    """
+Returns the value of the Python expression s as a Static if s is a literal
+string or number, otherwise None.
+    """
+    try:
+        value = literal_eval(s.strip())
+        if isinstance(value, (basestring, int, long, float)):
+            return Static(unicode(value))
+    except (TypeError, ValueError, SyntaxError, UnicodeError):
+        pass
+    return None
+
+def format_attrs(id, klass, a, wrapper):
+    """
+Returns the HTML for a tag's attributes.  Arguments:
+
+id, klass: the id and class given with # and . (merged with the ones in a)
+a: the attribute dictionary
+wrapper: the character to quote attribute values with
+    """
+    a = dict((k,v) for k,v in a.items() if v != None)
+    if id:
+        a['id'] = id + '_' + a.get('id','') if 'id' in a else id
+    if klass:
+        a['class'] = (klass + ' ' + a.get('class','')).strip()
+    html = []
+    for k,v in a.items():
+        if v is None or v is False: continue
+        if v is True: v = k # for things like checked=checked
+        if hasattr(v, '__html__'):
+            #markup is not escaped, but must not end the value early
+            v = v.__html__()
+        else:
+            v = unicode(v)
+        v = v.replace(wrapper, {'"':'&quot;', "'":'&#39;'}[wrapper])
+        html.append(' %s=%s%s%s' % (k,wrapper,v,wrapper))
+    return ''.join(html)
+
 class HamlCall(object):
     """
 Represents a single compiled Python statement.  As the name of this class
@@ -81,6 +139,20 @@ Returns a compiled Python string representing this code.
             )
         return code
 
+class Static(object):
+    """
+A write argument whose value is known at compile time.  Calling str or repr on
+an instance gives the Python literal for the value.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return repr(self.value)
+
+    __str__ = __repr__
+
 class HamlObj(object):
     """
 An element of the HAMl file (e.g. tag, script, filter).
@@ -139,10 +211,6 @@ HamlCall constructor.
             #entab and detab cancel each other out
             if next.func == 'detab' and last.func == 'entab':
                 return self.src.pop()
-            #merge multiple write calls into one
-            elif next.func == 'write':
-                if next.func == last.func:
-                    return last.args.extend(next.args)
 
         self.src.append(next)
 
@@ -157,7 +225,7 @@ HTML.
     def convert_inline_python(self, s):
         """
 Converts a string that can contain inline Python to a Python expression that
-returns the string.  This works like repr on strings without inline Python.
+returns the string.  Strings without inline Python are returned as a Static.
 Syntax for inline Python:
 
 some text @{python(code)} some more text
@@ -214,7 +282,7 @@ some tex \@{not python some more text
 
         fmt = "".join(fmt)
         if len(args) == 0:
-            return repr(fmt.replace('%%', '%'))
+            return Static(fmt.replace('%%', '%'))
         else:
             if len(args) == 1:
                 #in case eval(args[0]) is a tuple
@@ -234,6 +302,15 @@ string before writing it.
         if literal:
             s = self.convert_inline_python(s)
         else:
+            s = constant(s) or s
+        if isinstance(s, Static):
+            #the value is known now, so it is escaped now too
+            if escape:
+                s = Static(escape_html(s.value))
+            if preserve_whitespace:
+                s = Static(s.value.replace('\n', '&#x000A;'))
+            return self.call(func='write', args=[s])
+        if not literal:
             #newline is appended sometimes to handle cases like this:
             #="some string" #a comment
             #if a newline is not appended, the comment will comment out the 
@@ -242,7 +319,10 @@ string before writing it.
             #contain a comment, but this does not matter much.
             if "#" in s:
                 s = s + "\n"
-            s = "unicode(%s)" % s
+            #_haml.escape converts values that are not strings itself, and
+            #leaves safe markup alone
+            if not escape:
+                s = "unicode(%s)" % s
         if escape:
             s = '_haml.escape(%s)' % s
         if preserve_whitespace:
@@ -265,10 +345,20 @@ id: the value of the id attribute
 klass: the value of the class attribute
 attrs: the other attributes as a string representation of a Python dictionary
 expression (e.g. '{"href": "http://www.getaround.com"}')
+
+When the dictionary is a literal the attributes are rendered now and written
+as a static string.
         """
         if attrs != '{}' or klass or id:
-            args = [repr(id), repr(klass), attrs]
-            self.call(func='attrs', args=args)
+            try:
+                value = literal_eval(attrs.strip())
+                html = format_attrs(id, klass, value,
+                    self.parser.op.attr_wrapper)
+            except (TypeError, ValueError, SyntaxError, AttributeError,
+                    UnicodeError):
+                args = [repr(id), repr(klass), attrs]
+                return self.call(func='attrs', args=args)
+            self.call(func='write', args=[Static(html)])
 
     def enblock(self):
         """
@@ -346,6 +436,17 @@ class Filter(HamlObj):
         HamlObj.__init__(self, parser, **kwargs)
         self.lines = []
 
+    def backend(self, name):
+        """
+Imports and returns the module a filter depends on.  Backends are imported the
+first time a template uses the filter rather than when pyhaml is imported.
+        """
+        try:
+            __import__(name)
+        except ImportError:
+            self.error('filter requires the %s module' % name)
+        return sys.modules[name]
+
     def open(self):
         for l in self.lines:
             self.push(l, literal=True)
@@ -379,10 +480,29 @@ class MarkdownFilter(Filter):
     
     def open(self):
         code = '\n'.join(self.lines)
-        html = markdown.markdown(code)
+        html = self.backend('markdown').markdown(code)
         for line in html.split('\n'):
             self.push(line, literal=True)
 
+filters = {
+    'plain': Filter,
+    'javascript': JavascriptFilter,
+    'escaped': EscapedFilter,
+    'markdown': MarkdownFilter,
+}
+
+#(name, class) for every call to register_filter, in order.  Compiled code
+#depends on the filters, so the engine's fingerprint includes this.
+registered = []
+
+def register_filter(name, cls):
+    """
+Makes the Filter subclass cls available to templates as :name.  Templates
+compiled before are compiled again.
+    """
+    filters[name] = cls
+    registered.append((name, '%s.%s' % (cls.__module__, cls.__name__)))
+
 class Content(HamlObj):
 
     def __init__(self, parser, value, **kwargs):
@@ -421,6 +541,13 @@ class SilentScript(HamlObj):
 
     def __init__(self, parser, value='', **kwargs):
         HamlObj.__init__(self, parser, **kwargs)
+        m = cached_with.match(value)
+        if m:
+            (indent, call, name) = m.groups()
+            value = '%sfor %s in %s:' % (indent, name or '_haml_fragment', call)
+        elif other_cached_with.match(value):
+            self.error('with _haml.cached(...) can only be followed by '
+                'as name and a comment')
         self.value = value
 
     def entab(self):
@@ -548,6 +675,205 @@ class Tag(HamlObj):
             s = '</' + self.tagname + '>'
         self.push(s, closing=True, literal=True)
 
+class Folder(object):
+    """
+Resolves indentation and whitespace trimming at compile time.  The folder
+follows the list of HamlCalls produced by the parser, tracking the HTML depth
+and whether the next indent is trimmed.  Where both are known the indent,
+entab, detab and trim calls disappear and adjacent writes are merged, so a run
+of static markup becomes a single constant string.
+
+Python code (- lines) may write, indent or trim by calling functions, so the
+trim state is unknown after a script line and at the start of every block.
+The depth is known everywhere except inside def blocks, whose bodies run at the
+depth of the caller, and _haml.cached blocks, whose HTML may be replayed at
+another depth.  The runtime depth and trim state are brought up to date
+before every script line, dynamic write and attribute dictionary and at the
+end of every block, so code that runs outside the folded calls sees the same
+state it would have without folding.
+
+With relative set, the template is compiled to be imported by another one, and
+its top level runs at the depth and trim state of the importer.  Both are
+unknown, as in a def block, and are handed back at the end.
+
+With ugly set, the HTML is not indented at all.  The depth is never tracked, so
+no entab or detab calls are generated and indents only write newlines.  Only
+indents whose trimming depends on code run at render time remain as calls.
+    """
+
+    def __init__(self, ugly=False, relative=False):
+        self.ugly = ugly
+        self.relative = relative
+        self.out = []
+        self.stack = []
+        self.pydepth = 0
+        #the write call that static and dynamic arguments are added to
+        self.writes = None
+        #the last script call, which opens a block if deeper calls follow
+        self.header = None
+        #whether depth is the absolute HTML depth or relative to a def's caller
+        self.known = True
+        #depth and trimmed are what the HTML needs, rt_depth and rt_trimmed are
+        #what the engine has been told so far.  None means the trim is unknown.
+        self.depth = 0
+        self.rt_depth = 0
+        self.trimmed = False
+        self.rt_trimmed = False
+        if relative:
+            (self.known, self.trimmed, self.rt_trimmed) = (False, None, None)
+
+    def fold(self, src):
+        """
+Returns the folded list of HamlCalls for src.
+        """
+        for call in src:
+            while call.depth < self.pydepth:
+                self.leave()
+            if call.depth > self.pydepth:
+                self.enter()
+            getattr(self, call.func or 'script')(call)
+        while self.pydepth > 0:
+            self.leave()
+        if self.relative and src:
+            #the importer carries on from where the template left off
+            self.sync(src[-1].haml)
+        return self.out
+
+    def emit(self, call):
+        self.writes = None
+        self.out.append(call)
+
+    def emit_call(self, haml, func, *args):
+        self.emit(HamlCall(depth=self.pydepth, haml=haml, func=func,
+            args=list(args)))
+
+    def state(self):
+        return (self.known, self.depth, self.rt_depth,
+            self.trimmed, self.rt_trimmed)
+
+    def enter(self):
+        """
+Called when the calls following a script line are indented, ie. it opened a
+block.
+        """
+        self.stack.append((self.header, len(self.out), self.state()))
+        self.pydepth += 1
+        if relative_block.match(self.header.script):
+            (self.known, self.depth, self.rt_depth) = (False, 0, 0)
+        (self.trimmed, self.rt_trimmed) = (None, None)
+
+    def leave(self):
+        """
+Called at the end of a block.
+        """
+        self.sync(self.header and self.header.haml)
+        (header, start, state) = self.stack.pop()
+        if len(self.out) == start:
+            #everything in the block folded away
+            self.emit(HamlCall(depth=self.pydepth, haml=header.haml,
+                script='\t' * self.pydepth + 'pass'))
+        self.pydepth -= 1
+        self.writes = None
+        self.header = header
+        (self.known, self.depth, self.rt_depth,
+            self.trimmed, self.rt_trimmed) = state
+        if not re.match(r'\s*def\b', header.script):
+            #the block may have run any number of times
+            (self.trimmed, self.rt_trimmed) = (None, None)
+
+    def sync_depth(self, haml):
+        delta = self.depth - self.rt_depth
+        if delta:
+            func = delta > 0 and 'entab' or 'detab'
+            self.emit_call(haml, func, *(abs(delta) > 1 and [abs(delta)] or []))
+            self.rt_depth = self.depth
+
+    def sync(self, haml):
+        """
+Tells the engine about any depth change or trim that has been folded away.
+        """
+        self.sync_depth(haml)
+        if self.trimmed and not self.rt_trimmed:
+            self.emit_call(haml, 'trim')
+            self.rt_trimmed = True
+
+    def script(self, call):
+        self.sync(call.haml)
+        self.emit(call)
+        self.header = call
+        (self.trimmed, self.rt_trimmed) = (None, None)
+
+    def entab(self, call):
+        if not self.ugly:
+            self.depth += 1
+
+    def detab(self, call):
+        if not self.ugly:
+            self.depth -= 1
+
+    def trim(self, call):
+        self.trimmed = True
+
+    def indent(self, call):
+        (indent,) = call.args
+        if self.ugly and indent:
+            indent = False
+            call = HamlCall(depth=call.depth, haml=call.haml, func='indent',
+                args=[False])
+        if self.trimmed:
+            if self.rt_trimmed:
+                #let the engine clear its trim flag
+                self.emit(call)
+            elif self.rt_trimmed is None:
+                #the engine may have been trimmed by code, clear its flag
+                #without writing
+                self.emit_call(call.haml, 'untrim')
+            (self.trimmed, self.rt_trimmed) = (False, False)
+        elif self.trimmed is None or indent and not self.known:
+            if indent:
+                self.sync_depth(call.haml)
+            self.emit(call)
+            (self.trimmed, self.rt_trimmed) = (False, False)
+        else:
+            self.add(call, Static('\n' + ('  ' * self.depth if indent else '')))
+
+    def write(self, call):
+        for arg in call.args:
+            self.add(call, arg)
+
+    def add(self, call, arg):
+        """
+Adds a write argument.  Static arguments are merged into one string.  Dynamic
+arguments from another Haml line start a new write call so that errors in them
+are reported at the right line.
+        """
+        if not isinstance(arg, Static):
+            #the expression may call a function that writes
+            self.sync(call.haml)
+        if self.writes != None:
+            last = self.writes.args[-1]
+            if isinstance(arg, Static) and isinstance(last, Static):
+                try:
+                    self.writes.args[-1] = Static(last.value + arg.value)
+                    return
+                except UnicodeError:
+                    pass
+            elif isinstance(arg, Static) or self.writes.haml is call.haml:
+                return self.writes.args.append(arg)
+        self.emit_call(call.haml, 'write', arg)
+        self.writes = self.out[-1]
+
+    def attrs(self, call):
+        self.sync(call.haml)
+        self.emit(call)
+
+def fold(src, ugly=False, relative=False):
+    """
+Resolves the indentation and trimming that is known at compile time in a list
+of HamlCalls.  See Folder.
+    """
+    return Folder(ugly, relative).fold(src)
+
 def get_lines_in_position_range(lexdata, lexstart, lexend):
     """
 Given a string, a starting position, and an ending position, this function grabs
@@ -575,6 +901,7 @@ def p_haml_doc(p):
     #this code is reached at the end of parsing, so close all unclosed objects
     while len(p.parser.to_close):
         p.parser.to_close.pop().end()
+    p.parser.src = fold(p.parser.src, p.parser.op.ugly, p.parser.relative)
 
 def p_doc(p):
     '''doc : obj
@@ -601,17 +928,11 @@ def p_filter(p):
                 | filter FILTERBLANKLINES
                 | FILTER'''
     if len(p) == 2:
-        types = {
-            'plain': Filter,
-            'javascript': JavascriptFilter,
-            'escaped': EscapedFilter,
-            'markdown': MarkdownFilter,
-        }
         haml_indent, filter_name = p[1]
-        if not filter_name in types:
+        if not filter_name in filters:
             raise HamlParserException, (
                 p.lineno(0), p.lexpos(0), 'Invalid filter: %s' % filter_name)
-        p[0] = types[filter_name](p.parser, posinfo=get_position_info(p),
+        p[0] = filters[filter_name](p.parser, posinfo=get_position_info(p),
 haml_indent = haml_indent)
     elif len(p) == 3:
         p[0] = p[1]
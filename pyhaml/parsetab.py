@@ -0,0 +1,73 @@
+
+# pyhaml/parsetab.py
+# This file is automatically generated. Do not edit.
+_tabversion = '3.2'
+
+_lr_method = 'LALR'
+
+_lr_signature = '\x82\xa3r"@]\xfd\xba\xcdn \x7f\xa7\xee\xbbd'
+    
+_lr_action_items = {'COMMENT':([0,1,2,3,4,5,6,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,29,30,31,32,33,34,35,36,37,38,39,40,41,42,43,44,],[11,-10,-21,-18,-38,-17,-40,-11,-13,-9,-26,-14,-37,-41,-42,-4,11,-12,-20,-7,-8,-19,-24,-23,-22,-44,-31,-39,-43,-27,11,-5,-36,-16,-15,-25,-29,-32,-6,-33,-30,-35,-28,-34,]),'FILTER':([0,1,2,3,4,5,6,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,29,30,31,32,33,34,35,36,37,38,39,40,41,42,43,44,],[5,-10,-21,-18,-38,-17,-40,-11,-13,-9,-26,-14,-37,-41,-42,-4,5,-12,-20,-7,-8,-19,-24,-23,-22,-44,-31,-39,-43,-27,5,-5,-36,-16,-15,-25,-29,-32,-6,-33,-30,-35,-28,-34,]),'FILTERCONTENT':([5,21,34,35,],[-17,35,-16,-15,]),'/':([4,6,14,15,26,27,28,29,37,38,],[-38,-40,-41,-42,-44,-31,-39,-43,41,-32,]),'SCRIPT':([0,1,2,3,4,5,6,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,29,30,31,32,33,34,35,36,37,38,39,40,41,42,43,44,],[22,-10,-21,-18,-38,-17,-40,-11,-13,-9,-26,-14,-37,-41,-42,-4,22,-12,-20,-7,-8,-19,-24,-23,-22,-44,-31,-39,-43,-27,22,-5,-36,-16,-15,-25,-29,-32,-6,22,-30,-35,-28,-34,]),'HTMLTYPE':([2,],[25,]),'XMLTYPE':([2,],[24,]),'DOCTYPE':([0,1,2,3,4,5,6,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,29,30,31,32,33,34,35,36,37,38,39,40,41,42,43,44,],[2,-10,-21,-18,-38,-17,-40,-11,-13,-9,-26,-14,-37,-41,-42,-4,2,-12,-20,-7,-8,-19,-24,-23,-22,-44,-31,-39,-43,-27,2,-5,-36,-16,-15,-25,-29,-32,-6,-33,-30,-35,-28,-34,]),'SILENTSCRIPT':([0,1,2,3,4,5,6,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,29,30,31,32,33,34,35,36,37,38,39,40,41,42,43,44,],[3,-10,-21,-18,-38,-17,-40,-11,-13,-9,-26,-14,-37,-41,-42,-4,3,-12,-20,-7,-8,-19,-24,-23,-22,-44,-31,-39,-43,-27,3,-5,-36,-16,-15,-25,-29,-32,-6,-33,-30,-35,-28,-34,]),'CLASSNAME':([0,1,2,3,4,5,6,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,29,30,31,32,33,34,35,36,37,38,39,40,41,42,43,44,],[15,-10,-21,-18,26,-17,-40,-11,-13,-9,-26,-14,-37,-41,-42,-4,15,-12,-20,-7,-8,-19,-24,-23,-22,-44,-31,-39,-43,-27,15,-5,-36,-16,-15,-25,-29,-32,-6,-33,-30,-35,-28,-34,]),'TRIM':([4,6,14,15,26,27,28,29,],[-38,-40,-41,-42,-44,38,-39,-43,]),'LF':([1,2,3,4,5,6,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,29,30,32,33,34,35,36,37,38,39,40,41,42,43,44,],[-10,-21,-18,-38,-17,-40,-11,-13,-9,-26,-14,-37,-41,-42,-4,31,-12,-20,-7,-8,-19,-24,-23,-22,-44,-31,-39,-43,-27,-5,-36,-16,-15,-25,-29,-32,-6,-33,-30,-35,-28,-34,]),'DICT':([4,6,14,15,26,29,],[28,-40,-41,-42,-44,-43,]),'VALUE':([0,1,2,3,4,5,6,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,29,30,31,32,33,34,35,36,37,38,39,40,41,42,43,44,],[13,-10,-21,-18,-38,-17,-40,-11,-13,-9,30,-14,-37,-41,-42,-4,13,-12,33,-7,-8,-19,36,-23,-22,-44,-31,-39,-43,-27,13,-5,-36,-16,-15,-25,-29,-32,-6,13,-30,-35,-28,33,]),'TAGNAME':([0,1,2,3,4,5,6,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,29,30,31,32,33,34,35,36,37,38,39,40,41,42,43,44,],[6,-10,-21,-18,-38,-17,-40,-11,-13,-9,-26,-14,-37,-41,-42,-4,6,-12,-20,-7,-8,-19,-24,-23,-22,-44,-31,-39,-43,-27,6,-5,-36,-16,-15,-25,-29,-32,-6,-33,-30,-35,-28,-34,]),'FILTERBLANKLINES':([5,21,34,35,],[-17,34,-16,-15,]),'CONDCOMMENT':([0,1,2,3,4,5,6,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,29,30,31,32,33,34,35,36,37,38,39,40,41,42,43,44,],[23,-10,-21,-18,-38,-17,-40,-11,-13,-9,-26,-14,-37,-41,-42,-4,23,-12,-20,-7,-8,-19,-24,-23,-22,-44,-31,-39,-43,-27,23,-5,-36,-16,-15,-25,-29,-32,-6,-33,-30,-35,-28,-34,]),'ID':([0,1,2,3,4,5,6,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,29,30,31,32,33,34,35,36,37,38,39,40,41,42,43,44,],[14,-10,-21,-18,-38,-17,29,-11,-13,-9,-26,-14,-37,-41,-42,-4,14,-12,-20,-7,-8,-19,-24,-23,-22,-44,-31,-39,-43,-27,14,-5,-36,-16,-15,-25,-29,-32,-6,-33,-30,-35,-28,-34,]),'$end':([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,29,30,31,32,33,34,35,36,37,38,39,40,41,42,43,44,],[-1,-10,-21,-18,-38,-17,-40,0,-11,-13,-9,-26,-14,-37,-41,-42,-4,-2,-12,-20,-7,-8,-19,-24,-23,-22,-44,-31,-39,-43,-27,-3,-5,-36,-16,-15,-25,-29,-32,-6,-33,-30,-35,-28,-34,]),}
+
+_lr_action = { }
+for _k, _v in _lr_action_items.items():
+   for _x,_y in zip(_v[0],_v[1]):
+      if not _x in _lr_action:  _lr_action[_x] = { }
+      _lr_action[_x][_k] = _y
+del _lr_action_items
+
+_lr_goto_items = {'comment':([0,17,31,],[1,1,1,]),'content':([0,17,31,],[10,10,10,]),'trim':([27,],[37,]),'obj':([0,17,31,],[16,32,39,]),'script':([0,17,31,40,],[9,9,9,42,]),'doc':([0,],[17,]),'selfclose':([37,],[40,]),'doctype':([0,17,31,],[18,18,18,]),'silentscript':([0,17,31,],[12,12,12,]),'element':([0,17,31,],[20,20,20,]),'filter':([0,17,31,],[21,21,21,]),'tag':([0,17,31,],[4,4,4,]),'dict':([4,],[27,]),'value':([0,17,31,40,],[19,19,19,44,]),'text':([40,],[43,]),'haml':([0,],[7,]),'condcomment':([0,17,31,],[8,8,8,]),}
+
+_lr_goto = { }
+for _k, _v in _lr_goto_items.items():
+   for _x,_y in zip(_v[0],_v[1]):
+       if not _x in _lr_goto: _lr_goto[_x] = { }
+       _lr_goto[_x][_k] = _y
+del _lr_goto_items
+_lr_productions = [
+  ("S' -> haml","S'",1,None,None,None),
+  ('haml -> <empty>','haml',0,'p_haml_doc','pyhaml/parser.py',572),
+  ('haml -> doc','haml',1,'p_haml_doc','pyhaml/parser.py',573),
+  ('haml -> doc LF','haml',2,'p_haml_doc','pyhaml/parser.py',574),
+  ('doc -> obj','doc',1,'p_doc','pyhaml/parser.py',580),
+  ('doc -> doc obj','doc',2,'p_doc','pyhaml/parser.py',581),
+  ('doc -> doc LF obj','doc',3,'p_doc','pyhaml/parser.py',582),
+  ('obj -> element','obj',1,'p_obj','pyhaml/parser.py',586),
+  ('obj -> filter','obj',1,'p_obj','pyhaml/parser.py',587),
+  ('obj -> content','obj',1,'p_obj','pyhaml/parser.py',588),
+  ('obj -> comment','obj',1,'p_obj','pyhaml/parser.py',589),
+  ('obj -> condcomment','obj',1,'p_obj','pyhaml/parser.py',590),
+  ('obj -> doctype','obj',1,'p_obj','pyhaml/parser.py',591),
+  ('obj -> script','obj',1,'p_obj','pyhaml/parser.py',592),
+  ('obj -> silentscript','obj',1,'p_obj','pyhaml/parser.py',593),
+  ('filter -> filter FILTERCONTENT','filter',2,'p_filter','pyhaml/parser.py',600),
+  ('filter -> filter FILTERBLANKLINES','filter',2,'p_filter','pyhaml/parser.py',601),
+  ('filter -> FILTER','filter',1,'p_filter','pyhaml/parser.py',602),
+  ('silentscript -> SILENTSCRIPT','silentscript',1,'p_silentscript','pyhaml/parser.py',627),
+  ('script -> SCRIPT','script',1,'p_script','pyhaml/parser.py',634),
+  ('content -> value','content',1,'p_content','pyhaml/parser.py',642),
+  ('doctype -> DOCTYPE','doctype',1,'p_doctype','pyhaml/parser.py',646),
+  ('doctype -> DOCTYPE HTMLTYPE','doctype',2,'p_htmltype','pyhaml/parser.py',650),
+  ('doctype -> DOCTYPE XMLTYPE','doctype',2,'p_xmltype','pyhaml/parser.py',655),
+  ('condcomment -> CONDCOMMENT','condcomment',1,'p_condcomment','pyhaml/parser.py',663),
+  ('condcomment -> CONDCOMMENT VALUE','condcomment',2,'p_condcomment','pyhaml/parser.py',664),
+  ('comment -> COMMENT','comment',1,'p_comment','pyhaml/parser.py',670),
+  ('comment -> COMMENT VALUE','comment',2,'p_comment','pyhaml/parser.py',671),
+  ('element -> tag dict trim selfclose text','element',5,'p_element','pyhaml/parser.py',677),
+  ('selfclose -> <empty>','selfclose',0,'p_selfclose','pyhaml/parser.py',686),
+  ('selfclose -> /','selfclose',1,'p_selfclose','pyhaml/parser.py',687),
+  ('trim -> <empty>','trim',0,'p_trim','pyhaml/parser.py',691),
+  ('trim -> TRIM','trim',1,'p_trim','pyhaml/parser.py',692),
+  ('text -> <empty>','text',0,'p_text','pyhaml/parser.py',699),
+  ('text -> value','text',1,'p_text','pyhaml/parser.py',700),
+  ('text -> script','text',1,'p_text','pyhaml/parser.py',701),
+  ('value -> value VALUE','value',2,'p_value','pyhaml/parser.py',706),
+  ('value -> VALUE','value',1,'p_value','pyhaml/parser.py',707),
+  ('dict -> <empty>','dict',0,'p_dict','pyhaml/parser.py',714),
+  ('dict -> DICT','dict',1,'p_dict','pyhaml/parser.py',715),
+  ('tag -> TAGNAME','tag',1,'p_tag_tagname','pyhaml/parser.py',722),
+  ('tag -> ID','tag',1,'p_tag_id','pyhaml/parser.py',727),
+  ('tag -> CLASSNAME','tag',1,'p_tag_class','pyhaml/parser.py',732),
+  ('tag -> TAGNAME ID','tag',2,'p_tag_tagname_id','pyhaml/parser.py',737),
+  ('tag -> tag CLASSNAME','tag',2,'p_tag_tag_class','pyhaml/parser.py',743),
+]
@@ -0,0 +1,203 @@
+"""
+Benchmarks for pyHaml.  Run from the root of the repository:
+
+    python test/bench.py [suite ...]
+
+The startup suite measures the cold start phases (importing pyhaml.haml,
+constructing an Engine, the first compile and the first render) in fresh
+subprocesses and compares them against test/bench_baseline.txt.  Pass --save to
+record a new baseline.  The tables suite compares building the parser and lexer
+from their rules with loading the generated tables.  The escape suite times
+pyhaml.escape against cgi.escape over values of several sizes and mixes of
+characters.
+"""
+from __future__ import with_statement
+import os
+import sys
+import time
+import subprocess
+from optparse import OptionParser
+
+dir = os.path.dirname(os.path.abspath(__file__))
+parent = os.path.dirname(dir)
+sys.path.insert(0, parent)
+
+baseline_path = os.path.join(dir, 'bench_baseline.txt')
+template = os.path.join(dir, 'haml', 'basic.haml')
+
+phases = ['import', 'engine', 'compile', 'render']
+
+#run in a fresh interpreter for every sample, prints "phase seconds" lines.
+#the import phase includes building the module level pyhaml.haml.eng
+child = '''
+import sys, time
+sys.path.insert(0, %(parent)r)
+t = [time.time()]
+import pyhaml.haml
+t.append(time.time())
+eng = pyhaml.haml.Engine()
+t.append(time.time())
+eng.setops(filename=%(template)r)
+code = eng.cache(%(template)r)
+t.append(time.time())
+eng.execute(code)
+t.append(time.time())
+for (phase, start, end) in zip(%(phases)r, t, t[1:]):
+    sys.stdout.write('%%s %%r\\n' %% (phase, end - start))
+'''
+
+def best(f, repeat=5, number=10):
+    """Returns the best time in seconds of a single call to f."""
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        for _ in range(number):
+            f()
+        times.append((time.time() - start) / number)
+    return min(times)
+
+def report(name, t, base=None, unit='ms'):
+    scale = {'ms': 1e3, 'us': 1e6}[unit]
+    line = '%-20s %8.3f %s' % (name, t * scale, unit)
+    if base:
+        line += ' %+7.1f%%' % ((t - base) / base * 100)
+    sys.stdout.write(line + '\n')
+
+def sample():
+    """Runs the startup phases once in a fresh interpreter."""
+    src = child % {'parent': parent, 'template': template, 'phases': phases}
+    proc = subprocess.Popen([sys.executable, '-c', src],
+        stdout=subprocess.PIPE)
+    out = proc.communicate()[0]
+    if proc.returncode:
+        raise RuntimeError('benchmark subprocess failed')
+    result = {}
+    for line in out.decode().splitlines():
+        (phase, t) = line.split()
+        result[phase] = float(t)
+    return result
+
+def read_baseline():
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            for line in f:
+                (phase, t) = line.split()
+                baseline[phase] = float(t)
+    return baseline
+
+def write_baseline(results):
+    with open(baseline_path, 'w') as f:
+        for phase in phases:
+            f.write('%s %r\n' % (phase, results[phase]))
+
+def startup(op):
+    """
+Reports the best time of each startup phase over op.runs subprocesses.  Returns
+the phases that regressed by more than op.threshold percent and op.slack
+milliseconds over the baseline.
+    """
+    samples = [sample() for _ in range(op.runs)]
+    results = dict((p, min(s[p] for s in samples)) for p in phases)
+    baseline = read_baseline()
+    regressions = []
+    for phase in phases:
+        base = baseline.get(phase, 0)
+        report(phase, results[phase], base)
+        limit = max(base * (1 + op.threshold / 100.0), base + op.slack / 1000)
+        if base and results[phase] > limit:
+            regressions.append(phase)
+    report('total', sum(results.values()),
+        sum(baseline.get(p, 0) for p in phases))
+    if op.save:
+        write_baseline(results)
+    return regressions
+
+def tables(op):
+    from pyhaml import parser, lexer
+    from pyhaml.haml import build_parser, build_lexer, Engine
+    from pyhaml.ply import yacc, lex
+
+    def build_parser_rules():
+        #a table module that does not exist forces yacc to build the automaton
+        yacc.yacc(module=parser, tabmodule='pyhaml._no_parsetab',
+            write_tables=0, debug=0)
+
+    def build_lexer_rules():
+        lex.lex(module=lexer)
+
+    build = best(build_parser_rules)
+    load = best(build_parser)
+    report('parser build', build)
+    report('parser table load', load)
+    sys.stdout.write('%-20s %8.1fx\n' % ('speedup', build / load))
+    build = best(build_lexer_rules)
+    load = best(build_lexer)
+    report('lexer build', build)
+    report('lexer table load', load)
+    sys.stdout.write('%-20s %8.1fx\n' % ('speedup', build / load))
+    report('Engine()', best(Engine, number=1000))
+    return []
+
+def escape(op):
+    from pyhaml.escape import escape
+    try:
+        from cgi import escape as cgi_escape
+    except ImportError:
+        cgi_escape = None
+    mixes = [
+        ('plain', u'lorem ipsum '),
+        ('sparse', u'lorem ipsum dolor sit amet & '),
+        ('dense', u'<a href="#">&</a>'),
+    ]
+    for size in (10, 100, 1000, 10000):
+        for (mix, chunk) in mixes:
+            s = (chunk * (size // len(chunk) + 1))[:size]
+            name = '%s %d' % (mix, size)
+            base = None
+            if cgi_escape:
+                base = best(lambda: cgi_escape(s, True), number=1000)
+            report(name, best(lambda: escape(s), number=1000), base, 'us')
+    return []
+
+suites = {
+    'startup': startup,
+    'tables': tables,
+    'escape': escape,
+}
+
+optparser = OptionParser(usage='%prog [options] [suite ...]')
+
+optparser.add_option('-n', '--runs',
+    help='number of fresh processes to sample',
+    type='int',
+    dest='runs',
+    default=10)
+
+optparser.add_option('-t', '--threshold',
+    help='percentage over the baseline reported as a regression',
+    type='float',
+    dest='threshold',
+    default=25.0)
+
+optparser.add_option('-l', '--slack',
+    help='milliseconds over the baseline ignored as noise',
+    type='float',
+    dest='slack',
+    default=1.0)
+
+optparser.add_option('-s', '--save',
+    help='record the startup results as the new baseline',
+    action='store_true',
+    dest='save',
+    default=False)
+
+if __name__ == '__main__':
+    (op, args) = optparser.parse_args()
+    regressions = []
+    for name in args or ['startup', 'tables']:
+        sys.stdout.write('%s:\n' % name)
+        regressions += suites[name](op)
+    if regressions:
+        sys.stdout.write('regressed: %s\n' % ', '.join(regressions))
+        sys.exit(1)
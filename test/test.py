@@ -1,7 +1,9 @@
 from __future__ import with_statement
 import os
 import sys
+import shutil
 import difflib
+import tempfile
 import unittest
 from functools import partial
 from optparse import OptionValueError
@@ -12,8 +14,12 @@ sys.path.insert(0, parent)
 sys.path.insert(0, os.path.join(parent, 'pyhaml'))
 
 from pyhaml.patch import StringIO
-from pyhaml.parser import doctypes
-from pyhaml.haml import to_html, render
+from pyhaml.parser import doctypes, register_filter, Filter
+from pyhaml.escape import escape
+from pyhaml.deps import Graph, imports
+from pyhaml.cache import DiskCache
+from pyhaml.haml import to_html, render, Engine, HamlException
+from pyhaml import haml
 
 class TestHaml(unittest.TestCase):
     
@@ -87,6 +93,87 @@ class TestHaml(unittest.TestCase):
         self.assertEqual("<p><b></b></p>\n", to_html('-def f():\n %b\n%p<\n -f()'))
         self.assertEqual("<p><p>\n  foo\n</p></p>\n", to_html('%p\n %p>\n  foo'))
     
+    def testfold(self):
+        eng = Engine()
+        eng.setops()
+        eng.compile('!!!\n%html\n  %body\n    %p<\n      foo\n    %img>')
+        self.assertEqual(['write'], [c.func for c in eng.parser.src])
+        self.assertEqual('<p>\n  <b>0</b>\n  <b>1</b>\n</p>\n',
+            to_html('%p\n  -for i in range(2):\n    %b= i'))
+        self.assertEqual('<p><b>0</b><b>1</b></p>\n',
+            to_html('%p\n  -for i in range(2):\n    %b>= i'))
+        self.assertEqual('<div>\n  <p>\n    <b></b>\n  </p>\n</div>\n<b></b>\n',
+            to_html('-def f():\n  %b\n%div\n  %p\n    -f()\n-f()'))
+        self.assertEqual('<p>a</p>\n<q></q>\n',
+            to_html('-if True:\n  %p a\n-else:\n  %p b\n%q'))
+        #a trim the engine may not know about is cleared without writing
+        self.assertEqual('<i>\n  text\n</i><i>\n  text\n</i>\n',
+            to_html('-for i in range(2):\n  %i>\n    -for j in range(1):\n'
+                '      text'))
+        self.assertEqual('<ul>\n  <li></li>\n  <li>1</li>\n</ul>\n',
+            to_html('%ul\n  -for i in range(2):\n    %li<\n      -if i:\n'
+                '        = i'))
+        #a helper called from = writes at the depth of the tag
+        self.assertEqual('<div>\n  <p>\n  <b>x</b>r</p>\n</div>\n',
+            to_html('-def f():\n  %b x\n  -return "r"\n%div\n  %p= f()'))
+        #an imported template writes at the depth of the importer
+        root = tempfile.mkdtemp()
+        try:
+            p = os.path.join(root, 'page.haml')
+            with open(p, 'w') as f:
+                f.write('%div\n  %section\n    -_haml.imp("part")\n  %p after')
+            with open(os.path.join(root, 'part.haml'), 'w') as f:
+                f.write('%p part\n%ul\n  %li a')
+            self.assertEqual('<div>\n  <section>\n    <p>part</p>\n    <ul>\n'
+                '      <li>a</li>\n    </ul>\n  </section>\n  <p>after</p>\n'
+                '</div>\n', render(p))
+        finally:
+            shutil.rmtree(root)
+    
+    def testcodegen(self):
+        self.assertEqual('<p>0</p>\n<p>fin</p>\n',
+            to_html('-try:\n  -1/0\n-except ZeroDivisionError, ex:\n  %p 0\n'
+                '-else:\n  %p 1\n-finally:\n  %p fin'))
+        self.assertEqual('a\nb\nc\n', to_html('-for i in range(3):\n'
+            '  -if i == 0:\n    a\n  -elif i == 1:\n    b\n  -else:\n    c'))
+        self.assertEqual('<b>3</b>\n',
+            to_html('-def d(f):\n  -return f\n-@d\n-def g(x):\n  %b= x\n-g(3)'))
+        eng = Engine()
+        eng.setops()
+        try:
+            eng.compile('%p\n-x = (1,\n  2)\n%p= x\n%p\n  -for i in x i:\n    %b')
+        except HamlException, ex:
+            self.assertTrue('line 6' in ex[2])
+        else:
+            self.fail()
+    
+    def testrenderfunction(self):
+        self.assertEqual('<p>3</p>\n<p>4</p>\n2\n',
+            to_html('-for i in range(2):\n  %p= i + x\n-x = 2\n= x', { 'x': 3 },
+                render_function=True, context=['x']))
+        self.assertEqual('<b>1</b>\n', to_html('-def f(a):\n  %b= a\n-f(1)',
+            render_function=True))
+        #names may be unicode, and are None when the render does not set them
+        self.assertEqual('<p>3</p>\n<p>True</p>\n',
+            to_html('%p= x\n%p= y is None', { 'x': 3 }, render_function=True,
+                context=[u'x', u'y']))
+        for name in ('a-b', 'class', '_haml', u'caf\xe9', 1):
+            self.assertRaises(OptionValueError, to_html, '%p',
+                render_function=True, context=[name])
+    
+    def testoutput(self):
+        self.assertEqual('&#160;caf&#233;\n', to_html('= x', { 'x': u' \xa0caf\xe9 ' }))
+        self.assertEqual('<p>a</p>\n', to_html('= x\n%p a\n= x', { 'x': '  ' }))
+        self.assertEqual('\n', to_html('= x', { 'x': '  ' }))
+    
+    def testugly(self):
+        self.assertEqual('<div>\n<p>\na\n</p>\n<pre>x\ny</pre>\n</div>\n',
+            to_html('%div\n  %p\n    a\n  %pre\n    x\n    y', ugly=True))
+        eng = Engine()
+        eng.setops(ugly=True)
+        eng.compile('%div\n  %p\n    -for i in x:\n      %b= i')
+        self.assertFalse(set(['entab', 'detab']) & set(c.func for c in eng.parser.src))
+    
     def testflextabs(self):
         html = '<p>\n  foo\n</p>\n<q>\n  bar\n  <a>\n    baz\n  </a>\n</q>\n'
         self.assertEqual(html, to_html('%p\n  foo\n%q\n  bar\n  %a\n    baz'))
@@ -96,6 +183,16 @@ class TestHaml(unittest.TestCase):
     def testmultilineattrs(self):
         self.assertEqual("<p foo='bar'>val</p>\n", to_html("%p{  \n   'foo'  :  \n  'bar'  \n } val"))
     
+    def teststaticattrs(self):
+        eng = Engine()
+        eng.setops()
+        eng.compile("%a#x.y{'href': '/home', 'n': None, 'c': True}")
+        self.assertEqual(['write'], [c.func for c in eng.parser.src])
+        eng.compile("%a{'href': href}")
+        self.assertTrue('attrs' in [c.func for c in eng.parser.src])
+        self.assertEqual('<a href="/home" title="a&quot;b"></a>\n',
+            to_html("%a{'href': '/home', 'title': 'a\"b'}", attr_wrapper='"'))
+    
     def testcodeinattrs(self):
         self.assertEqual("<p foo='3'></p>\n", to_html("%p{ 'foo': 1+2 }"))
     
@@ -166,6 +263,29 @@ class TestHaml(unittest.TestCase):
         self.assertEqual('foo &gt; bar\n', to_html("= 'foo > bar'", escape_html=True))
         self.assertEqual('foo < bar\n', to_html("= 'foo < bar'", escape_html=False))
     
+    def testescape(self):
+        self.assertEqual('&lt;a href=&quot;?a=1&amp;b=2&quot;&gt;\n',
+            to_html("= '<a href=\"?a=1&b=2\">'"))
+        s = 'plain ' * 100 + '<'
+        self.assertEqual(s[:-1] + '&lt;', escape(s))
+        s = u'plain'
+        self.assertTrue(escape(s) is s)
+    
+    def testmarkup(self):
+        self.assertEqual('<b>&lt;</b>\n<a title="<b>x</b>"></a>\n',
+            to_html("-def b(x):\n  -return _haml.safe('<b>%s</b>' % _haml.escape(x))\n"
+                "= b('<')\n%a{'title': b('x')}", attr_wrapper='"'))
+        #markup still has the attribute wrapper escaped
+        self.assertEqual('<a title="a&quot;b"></a>\n',
+            to_html("%a{'title': _haml.safe('a\"b')}", attr_wrapper='"'))
+        self.assertEqual("<a title='a&#39;b'></a>\n",
+            to_html("%a{'title': _haml.safe(\"a'b\")}", attr_wrapper="'"))
+        self.assertEqual('<p>1</p>\n', to_html('%p= x', { 'x': 1 }))
+        eng = Engine()
+        eng.setops()
+        eng.compile("%p= 'a & b'\n= 3")
+        self.assertEqual(['write'], [c.func for c in eng.parser.src])
+    
     def testnosanitize(self):
         self.assertEqual('<&>\n', to_html("!='<&>'", escape_html=True))
         self.assertEqual('<&>\n', to_html("!='<&>'", escape_html=False))
@@ -261,6 +381,30 @@ class TestHaml(unittest.TestCase):
             "<script type='text/javascript'>\n  var foo;\n</script>\n",
             to_html(':javascript\n\tvar foo;'))
     
+    def testregisterfilter(self):
+        class Upper(Filter):
+            def open(self):
+                for l in self.lines:
+                    self.push(l.upper(), literal=True)
+        register_filter('upper', Upper)
+        self.assertEqual('FOO\nBAR\n', to_html(':upper\n foo\n bar'))
+        #strings compiled with the old filter are compiled again
+        class Lower(Upper):
+            def open(self):
+                for l in self.lines:
+                    self.push(l.lower(), literal=True)
+        register_filter('upper', Lower)
+        self.assertEqual('foo\nbar\n', to_html(':upper\n foo\n bar'))
+    
+    def testfingerprint(self):
+        eng = Engine()
+        eng.setops(context=['a', 'b'], preserve=['pre', 'code'])
+        fingerprint = eng.fingerprint
+        eng.setops(context=['b', 'a', 'b'], preserve=['code', 'pre'])
+        self.assertEqual(fingerprint, eng.fingerprint)
+        eng.setops(context=['a'], preserve=['pre', 'code'])
+        self.assertNotEqual(fingerprint, eng.fingerprint)
+    
     def testsuppress(self):
         self.assertEqual('<p></p>\n', to_html('%p = "foo"', suppress_eval=True))
         self.assertEqual('<p></p>\n', to_html("%p{'foo':'bar'}", suppress_eval=True))
@@ -278,6 +422,394 @@ class TestHaml(unittest.TestCase):
         self.assertEqual('<div class="foo"></div>\n', to_html('.foo', attr_wrapper='"'))
         self.assertRaises(OptionValueError, partial(to_html, '.foo', attr_wrapper=''))
     
+    def testengines(self):
+        (e1, e2) = (Engine(), Engine())
+        self.assertTrue(e1.parser.action is e2.parser.action)
+        self.assertTrue(e1.lexer.lexstatere is e2.lexer.lexstatere)
+        self.assertEqual('<br/>\n', e1.to_html('%br', format='xhtml'))
+        self.assertEqual('<br>\n', e2.to_html('%br', format='html5'))
+        self.assertEqual('<br/>\n', e1.to_html('%br', format='xhtml'))
+    
+    def testcachedir(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            p = os.path.join(dir, 'haml/func.haml')
+            html = render(p, cache_dir=tmp)
+            self.assertEqual(1, len(os.listdir(tmp)))
+            eng = Engine()
+            eng.compile = lambda *args: self.fail('compiled again')
+            self.assertEqual(html, eng.render(p, cache_dir=tmp))
+            Engine().render(p, cache_dir=tmp, ugly=True)
+            self.assertEqual(2, len(os.listdir(tmp)))
+        finally:
+            shutil.rmtree(tmp)
+    
+    def testcacheprune(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            cache = os.path.join(tmp, 'cache')
+            (p, q) = (os.path.join(tmp, 'p.haml'), os.path.join(tmp, 'q.haml'))
+            for path in (p, q):
+                with open(path, 'w') as f:
+                    f.write('%p a')
+            eng = Engine()
+            eng.render(p, cache_dir=cache)
+            eng.render(q, cache_dir=cache)
+            Engine().render(p, cache_dir=cache, ugly=True)
+            with open(os.path.join(cache, 'bad.hamlc'), 'w') as f:
+                f.write('junk')
+            self.assertEqual(4, len(os.listdir(cache)))
+            self.assertEqual(1, DiskCache(cache).prune())
+            self.assertEqual(3, len(os.listdir(cache)))
+            os.remove(q)
+            self.assertEqual(1, DiskCache(cache).prune())
+            self.assertEqual(1, DiskCache(cache).prune([eng.fingerprint]))
+            self.assertEqual(1, len(os.listdir(cache)))
+            eng.compile = lambda *args: self.fail('compiled again')
+            self.assertEqual('<p>a</p>\n', eng.render(p, cache_dir=cache))
+        finally:
+            shutil.rmtree(tmp)
+
+    def testcacheoptions(self):
+        p = os.path.join(dir, 'haml/basic.haml')
+        eng = Engine()
+        html5 = eng.render(p, format='html5')
+        xhtml = eng.render(p, format='xhtml')
+        self.assertNotEqual(html5, xhtml)
+        eng.compile = lambda *args: self.fail('compiled again')
+        self.assertEqual(html5, eng.render(p, format='html5'))
+        self.assertEqual(xhtml, eng.render(p, format='xhtml'))
+    
+    def testreload(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            p = os.path.join(tmp, 'page.haml')
+            with open(p, 'w') as f:
+                f.write('%p a')
+            eng = Engine()
+            self.assertEqual('<p>a</p>\n', eng.render(p, reload='never'))
+            with open(p, 'w') as f:
+                f.write('%p b')
+            os.utime(p, (0, os.path.getmtime(p) + 10))
+            self.assertEqual('<p>a</p>\n', eng.render(p, reload='never'))
+            self.assertEqual('<p>a</p>\n', eng.render(p, reload=60))
+            self.assertEqual('<p>b</p>\n', eng.render(p, reload='always'))
+            with open(p, 'w') as f:
+                f.write('%p c')
+            os.utime(p, (0, os.path.getmtime(p) + 20))
+            eng.invalidate(p)
+            self.assertEqual('<p>c</p>\n', eng.render(p, reload='never'))
+            self.assertRaises(OptionValueError, partial(eng.setops, reload='often'))
+        finally:
+            shutil.rmtree(tmp)
+    
+    def testcachelimits(self):
+        names = ['basic', 'func', 'lib']
+        paths = [os.path.join(dir, 'haml/%s.haml' % name) for name in names]
+        eng = Engine()
+        for p in paths:
+            eng.render(p, cache_size=2)
+        self.assertEqual(dict(hits=0, misses=3, evictions=1, entries=2),
+            dict((k, v) for (k, v) in eng.stats().items() if k != 'bytes'))
+        self.assertFalse((paths[0], eng.fingerprint) in eng.haml_line_cache)
+        eng.render(paths[2], cache_size=2)
+        self.assertEqual(1, eng.stats()['hits'])
+        eng.render(paths[0], cache_bytes=1)
+        self.assertEqual(1, eng.stats()['entries'])
+        self.assertTrue(0 < eng.stats()['bytes'])
+    
+    def teststringcache(self):
+        eng = Engine()
+        self.assertEqual('<p>1</p>\n', eng.to_html('%p= x', { 'x': 1 }))
+        eng.compile = lambda *args: self.fail('compiled again')
+        self.assertEqual('<p>2</p>\n', eng.to_html('%p= x', { 'x': 2 }))
+        self.assertEqual(dict(hits=1, misses=1, evictions=0, entries=1),
+            dict((k, v) for (k, v) in eng.stats(True).items() if k != 'bytes'))
+        del eng.compile
+        eng.to_html('%p= x', { 'x': 1 }, string_cache_size=1, escape_html=False)
+        self.assertEqual(1, eng.stats(True)['evictions'])
+        #a unicode string and its UTF-8 bytes are cached apart
+        src = u'%p caf\xe9'
+        for order in ([src, src.encode('utf-8')], [src.encode('utf-8'), src]):
+            eng = Engine()
+            for s in order:
+                self.assertEqual(isinstance(s, unicode) and
+                    '<p>caf&#233;</p>\n' or '<p>caf\xc3\xa9</p>\n',
+                    eng.to_html(s))
+    
+    def testfragmentcache(self):
+        src = '\n'.join([
+            '- def item(n):',
+            '  - with _haml.cached(\'item\', n):',
+            '    - calls.append(n)',
+            '    %li',
+            '      %b= n',
+            '%ul',
+            '  - item(1)',
+            '  %li',
+            '    %ul',
+            '      - item(1)',
+            '  - item(2)',
+        ])
+        html = '\n'.join([
+            '<ul>',
+            '  <li>',
+            '    <b>1</b>',
+            '  </li>',
+            '  <li>',
+            '    <ul>',
+            '      <li>',
+            '        <b>1</b>',
+            '      </li>',
+            '    </ul>',
+            '  </li>',
+            '  <li>',
+            '    <b>2</b>',
+            '  </li>',
+            '</ul>\n',
+        ])
+        eng = Engine()
+        calls = []
+        for i in range(2):
+            self.assertEqual(html, eng.to_html(src, { 'calls': calls }))
+        self.assertEqual([1, 2], calls)
+        eng.fragments.invalidate('item')
+        self.assertEqual(html, eng.to_html(src, { 'calls': calls },
+            render_function=True))
+        self.assertEqual([1, 2, 1, 2], calls)
+        self.assertEqual('\n'.join(line.strip() for line in html.split('\n')),
+            eng.to_html(src, { 'calls': calls }, ugly=True))
+        #as name and a trailing comment are allowed, other forms are errors
+        src = "-with _haml.cached('k') as frag: # cached\n  - calls.append(1)\n  %p"
+        calls = []
+        for i in range(2):
+            self.assertEqual('<p></p>\n', eng.to_html(src, { 'calls': calls }))
+        self.assertEqual([1], calls)
+        self.assertRaises(HamlException, eng.to_html,
+            "-with _haml.cached('k'), open('f'):\n  %p")
+    
+    def testpreload(self):
+        root = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(root, 'sub'))
+            names = ['a.haml', 'b.haml', os.path.join('sub', 'c.haml')]
+            for name in names:
+                with open(os.path.join(root, name), 'w') as f:
+                    f.write('%%p %s' % name)
+            with open(os.path.join(root, 'bad.haml'), 'w') as f:
+                f.write('- if')
+            paths = [os.path.join(root, name) for name in names]
+            eng = Engine()
+            failures = eng.preload(root, log=['sub/c.haml\n', 'b.haml\n',
+                os.path.join(root, 'sub', 'c.haml')], cache_size=2)
+            self.assertEqual({}, failures)
+            self.assertEqual(2, eng.stats()['entries'])
+            eng.compile = lambda *args: self.fail('compiled again')
+            self.assertEqual('<p>b.haml</p>\n',
+                eng.render(paths[1], cache_size=2))
+            self.assertEqual('<p>%s</p>\n' % names[2],
+                eng.render(paths[2], cache_size=2))
+            #the pool sends the code back marshalled
+            threshold = haml.pool_threshold
+            haml.pool_threshold = 0
+            try:
+                eng = Engine()
+                failures = eng.preload(root, processes=2)
+                self.assertEqual([os.path.join(root, 'bad.haml')],
+                    list(failures))
+            finally:
+                haml.pool_threshold = threshold
+            eng.compile = lambda *args: self.fail('compiled again')
+            for (name, p) in zip(names, paths):
+                self.assertEqual('<p>%s</p>\n' % name, eng.render(p))
+        finally:
+            shutil.rmtree(root)
+    
+    def testfinder(self):
+        p = os.path.join(dir, 'haml/imp.haml')
+        for i in range(3):
+            render(p, { 'bar': 'foo' })
+            to_html('%p')
+        self.assertEqual(1, sys.meta_path.count(haml.finder))
+        #templates are only imported while rendering
+        self.assertEqual(None, haml.finder.find_module('lib'))
+    
+    def testmodulecache(self):
+        (p, ext, lib) = [os.path.join(dir, 'haml/%s.haml' % name)
+            for name in ('imp', 'ext', 'lib')]
+        eng = Engine()
+        self.assertEqual('<a>foo</a>\n', eng.render(p, { 'bar': 'foo' }))
+        key = (lib, eng.import_fingerprint)
+        mod = eng.loaded[key][1]
+        self.assertFalse('lib' in sys.modules)
+        #reused with the globals of the render
+        self.assertEqual('<a>baz</a>\n', eng.render(ext, { 'bar': 'baz' }))
+        self.assertTrue(eng.loaded[key][1] is mod)
+        self.assertFalse('lib' in sys.modules)
+        eng.invalidate(lib)
+        self.assertEqual('<a>foo</a>\n', eng.render(p, { 'bar': 'foo' }))
+        self.assertFalse(eng.loaded[key][1] is mod)
+        #a module whose top level reads the render is executed every time
+        root = tempfile.mkdtemp()
+        try:
+            p = os.path.join(root, 'page.haml')
+            with open(p, 'w') as f:
+                f.write("- _haml.imp('lib2').hi()")
+            with open(os.path.join(root, 'lib2.haml'), 'w') as f:
+                f.write('\n'.join([
+                    "- greeting = 'Hello ' + name",
+                    '- items = []',
+                    '- def hi():',
+                    '  - items.append(name)',
+                    '  %p= greeting',
+                    '  %b= len(items)',
+                ]))
+            for name in ('A', 'B'):
+                self.assertEqual('<p>Hello %s</p>\n<b>1</b>\n' % name,
+                    eng.render(p, { 'name': name }, render_function=True))
+                self.assertEqual('<p>Hello %s</p>\n<b>1</b>\n' % name,
+                    eng.render(p, { 'name': name }))
+            self.assertFalse(
+                (os.path.join(root, 'lib2.haml'), eng.import_fingerprint) in eng.loaded)
+            #names read while defining are those of the render that defines
+            libs = [
+                ('-def hello(name=user):\n  %p= name', {}),
+                ('-class K:\n  -who = user\n-def hello():\n  %p= K.who', {}),
+                ('-def hello():\n  %p= user',
+                    { 'render_function': True, 'context': ['user'] }),
+            ]
+            for (i, (src, ops)) in enumerate(libs):
+                name = 'lib%d' % (i + 3)
+                with open(os.path.join(root, name + '.haml'), 'w') as f:
+                    f.write(src)
+                with open(p, 'w') as f:
+                    f.write("- _haml.imp(%r).hello()" % name)
+                eng = Engine()
+                for user in ('alice', 'bob'):
+                    self.assertEqual('<p>%s</p>\n' % user,
+                        eng.render(p, { 'user': user }, **ops))
+        finally:
+            shutil.rmtree(root)
+    
+    def testdeps(self):
+        self.assertEqual(['lib', 'a', 'b', 'c'], imports('\n'.join([
+            "- x = _haml.imp('lib')",
+            '%p',
+            '  - import a, b as d',
+            '- from c import e',
+            '- import lib',
+        ])))
+        (p, ext, lib) = [os.path.join(dir, 'haml/%s.haml' % name)
+            for name in ('imp', 'ext', 'lib')]
+        eng = Engine()
+        eng.render(p, { 'bar': 'foo' })
+        eng.render(ext, { 'bar': 'foo' })
+        self.assertEqual(set([lib]), eng.graph.dependencies(p))
+        self.assertEqual(set([p, ext]), eng.dependents(lib))
+        eng.invalidate(lib)
+        self.assertEqual(0, eng.stats()['entries'])
+        graph = Graph()
+        graph.add('a', 'b')
+        graph.add('b', 'c')
+        graph.add('d', 'c')
+        self.assertEqual(set(['a', 'b', 'd']), graph.dependents('c'))
+        self.assertEqual(['c', 'b', 'a', 'd'], graph.order(['a', 'd', 'c', 'b']))
+    
+    def testsearchpath(self):
+        root = tempfile.mkdtemp()
+        try:
+            (app, shared) = [os.path.join(root, name) for name in ('app', 'shared')]
+            os.makedirs(os.path.join(shared, 'layouts'))
+            os.mkdir(app)
+            with open(os.path.join(app, 'page.haml'), 'w') as f:
+                f.write('\n'.join([
+                    '- import layouts.base',
+                    "- nav = _haml.imp('nav')",
+                    '- layouts.base.page()',
+                    '- nav.links()',
+                ]))
+            with open(os.path.join(app, 'nav.haml'), 'w') as f:
+                f.write('- def links():\n  %a nav')
+            with open(os.path.join(shared, 'layouts', 'base.haml'), 'w') as f:
+                f.write('- def page():\n  %p base')
+            eng = Engine()
+            html = '<p>base</p>\n<a>nav</a>\n'
+            self.assertEqual(html, eng.render('page.haml',
+                search_path=[app, shared]))
+            #only the reload check of each template touches the filesystem
+            calls = []
+            stat = os.stat
+            os.stat = lambda path: calls.append(path) or stat(path)
+            try:
+                self.assertEqual(html, eng.render('page.haml',
+                    search_path=[app, shared]))
+            finally:
+                os.stat = stat
+            self.assertEqual(3, len(calls))
+            self.assertEqual(os.path.join(shared, 'layouts', 'base.haml'),
+                eng.resolve('layouts.base', None))
+            self.assertEqual(os.path.join(shared, 'layouts'),
+                eng.package('layouts'))
+            self.assertFalse('layouts' in sys.modules)
+            self.assertEqual(None, eng.resolve('missing', None))
+            with open(os.path.join(app, 'missing.haml'), 'w') as f:
+                f.write('%p')
+            eng.setops(search_path=[app, shared], index_reload='always')
+            self.assertEqual(os.path.join(app, 'missing.haml'),
+                eng.resolve('missing', None))
+        finally:
+            shutil.rmtree(root)
+    
+    def testarchive(self):
+        root = tempfile.mkdtemp()
+        try:
+            src = os.path.join(root, 'src')
+            os.makedirs(os.path.join(src, 'layouts'))
+            with open(os.path.join(src, 'page.haml'), 'w') as f:
+                f.write("- import lib\n- lib.foo()")
+            with open(os.path.join(src, 'lib.haml'), 'w') as f:
+                f.write('- def foo():\n  %p= bar')
+            with open(os.path.join(src, 'layouts', 'bad.haml'), 'w') as f:
+                f.write('- if')
+            with open(os.path.join(src, 'error.haml'), 'w') as f:
+                f.write('%p\n  = 1 / 0')
+            dest = os.path.join(root, 'templates.zip')
+            failures = Engine().pack(dest, src)
+            self.assertEqual([os.path.join(src, 'layouts', 'bad.haml')],
+                list(failures))
+            eng = Engine()
+            #the code in the archive is used as is
+            eng.compile = lambda *args: self.fail('compiled')
+            self.assertEqual('<p>foo</p>\n', eng.render('page.haml',
+                { 'bar': 'foo' }, archive=dest))
+            del eng.compile
+            self.assertEqual('<p>foo</p>\n', eng.render('page.haml',
+                { 'bar': 'foo' }, archive=dest, ugly=True))
+            self.assertRaises(HamlException, eng.render, 'layouts/bad.haml',
+                archive=dest)
+            #the archive works from another path, with errors pointing there
+            moved = os.path.join(root, 'moved.zip')
+            shutil.copy(dest, moved)
+            eng = Engine()
+            eng.compile = lambda *args: self.fail('compiled')
+            self.assertEqual('<p>foo</p>\n', eng.render('page.haml',
+                { 'bar': 'foo' }, archive=moved))
+            try:
+                eng.render('error.haml', archive=moved)
+                self.fail('rendered')
+            except HamlException, ex:
+                self.assertTrue(os.path.join(moved, 'error.haml') in str(ex))
+                self.assertTrue('= 1 / 0' in str(ex))
+            del eng.compile
+            #deploying a new archive replaces the old one
+            with open(os.path.join(src, 'lib.haml'), 'w') as f:
+                f.write('- def foo():\n  %a= bar')
+            Engine().pack(dest, src)
+            self.assertEqual('<a>foo</a>\n', eng.render('page.haml',
+                { 'bar': 'foo' }, archive=dest))
+        finally:
+            shutil.rmtree(root)
+    
     def testbasicdiff(self):
         self.diff('basic')
     